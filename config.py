@@ -1,8 +1,87 @@
 ##### Database #####
 TEST_COLLECTION_NAME = 'tests'
 WRITTEN_TEST_COLLECTION_NAME = 'written-tests'
+STUDENT_TEST_COLLECTION_NAME = 'student-tests'
 USER_COLLECTION_NAME = 'users'
 GROUP_COLLECTION_NAME = 'groups'
+DIALOG_STATE_COLLECTION_NAME = 'dialog-states'
+ACTIVE_SESSION_COLLECTION_NAME = 'active-sessions'
+
+# collection name -> indexes as (keys, options), applied at startup
+DATABASE_INDEXES = {
+        USER_COLLECTION_NAME: [
+            ([('telegram_id', 1)], { 'unique': True }),
+            # only the tutor has a role, there is a single tutor
+            ([('role', 1)], { 'unique': True, 'sparse': True }),
+            ([('group_id', 1), ('is_tutor', 1)], {}),
+            ([('is_tutor', 1)], {}),
+            ([('name', 1)], {}),
+            ],
+        GROUP_COLLECTION_NAME: [
+            ([('name', 1)], {}),
+            ],
+        TEST_COLLECTION_NAME: [
+            ([('name', 1)], {}),
+            ([('content_hash', 1), ('name', 1)], {}),
+            ],
+        WRITTEN_TEST_COLLECTION_NAME: [
+            ([('finish_time', 1)], {}),
+            ([('student_tests.student_id', 1)], {}),
+            ],
+        STUDENT_TEST_COLLECTION_NAME: [
+            ([('written_test_id', 1), ('student_id', 1)], { 'unique': True }),
+            ],
+        DIALOG_STATE_COLLECTION_NAME: [
+            ([('user_id', 1)], { 'unique': True }),
+            ],
+        ACTIVE_SESSION_COLLECTION_NAME: [
+            ([('written_test_id', 1)], { 'unique': True }),
+            ],
+        }
+
+# layout of written tests: 'embedded' keeps student tests inside the written
+# test document, 'student-tests' keeps them in STUDENT_TEST_COLLECTION_NAME
+WRITTEN_TEST_STORAGE = 'embedded'
+
+##### Caching #####
+# users and groups are cached by id and name for IDENTITY_CACHE_TTL seconds
+IDENTITY_CACHE_SIZE = 1024
+IDENTITY_CACHE_TTL = 300
+
+##### Grading #####
+# threads used by rapidfuzz to score lecture answers, -1 means all cores
+GRADING_WORKERS = -1
+# background grading of answers during the test
+GRADING_THREADS = 2
+GRADING_QUEUE_SIZE = 10000
+GRADING_BATCH_SIZE = 200
+
+##### Reports #####
+# processes writing reports of finished tests, 0 writes them in a thread
+REPORT_WORKERS = 2
+
+##### Variants #####
+# how variants are assigned to students on start:
+# 'random', 'seeded' (same variant for a student on every start) or
+# 'round-robin' (every variant is given to the same number of students)
+VARIANT_STRATEGY = 'random'
+VARIANT_SEED = ''
+
+##### Deadlines #####
+# time limits of a test and of every question in seconds, None means no limit.
+# When a limit expires the test is finished for the whole group or for the
+# student who has not answered in time.
+TEST_TIME_LIMIT = None
+QUESTION_TIME_LIMIT = None
+# deadlines are checked every DEADLINE_TICK seconds by one job
+DEADLINE_TICK = 1
+DEADLINE_WHEEL_SLOTS = 512
+
+##### Startup #####
+# --profile-startup fails if importing the bot takes longer than the budget
+# in seconds or loads modules which have to be imported on first use
+STARTUP_IMPORT_BUDGET = 1.5
+STARTUP_LAZY_MODULES = ['pandas', 'numpy', 'openpyxl', 'xlsxwriter', 'rapidfuzz', 'Levenshtein']
 
 ##### Runtime file storage #####
 RUNTIME_FOLDER = 'assets/runtime'
@@ -11,6 +90,21 @@ RUNTIME_FOLDER = 'assets/runtime'
 TESTS_FOLDERNAME = 'tests'
 WRITTEN_TESTS_FOLDERNAME = 'results'
 
+# uploaded tests and reports are processed in memory, copies are written to
+# RUNTIME_FOLDER in background if enabled
+ARCHIVE_FILES = True
+
+##### Excel reading #####
+# 'openpyxl' streams rows of xlsx workbooks, 'pandas' loads whole workbooks.
+# Files openpyxl cannot read are always read by pandas.
+EXCEL_READER = 'openpyxl'
+
+##### Excel writing #####
+# write reports row by row and flush them to disk instead of keeping them
+# in memory until the workbook is closed. Uses less memory for big groups,
+# but is slower and makes bigger files, as strings are not shared
+EXCEL_CONSTANT_MEMORY = False
+
 ##### Excel formatting #####
 HEADING_FORMAT = {
         'bold': True,
@@ -45,3 +139,25 @@ WRAPPED_FORMAT = {
         }
 DEFAULT_FONT_SIZE = 10
 DEFAULT_FONT_NAME = 'Arial'
+
+##### Telegram #####
+UPDATER_WORKERS = 4
+# updates are handled in this many threads, updates of one chat stay in order
+DISPATCH_WORKERS = 16
+# updates waiting in the update queue and, separately, in the dispatch
+# queues, 0 means unbounded queues
+UPDATE_QUEUE_SIZE = 1000
+
+# webhook mode, used when TELEGRAM_WEBHOOK_URL is set
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+
+##### Broadcasting #####
+# Telegram allows about 30 messages per second overall and about one
+# message per second in a single chat
+BROADCAST_GLOBAL_RATE = 30
+BROADCAST_CHAT_RATE = 1
+BROADCAST_CHAT_BURST = 3
+BROADCAST_WORKERS = 16
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_BACKOFF = 0.5 # seconds, doubled on every retry
@@ -1,10 +1,61 @@
+import argparse
 import os
+import sys
 import dotenv
 
+from config import DISPATCH_WORKERS, UPDATE_QUEUE_SIZE, WEBHOOK_LISTEN,\
+        WEBHOOK_PORT, WRITTEN_TEST_STORAGE
+from src.services.benchmarks import benchmark_answer_latency,\
+        benchmark_excel_reading, benchmark_grading, benchmark_import,\
+        benchmark_report_latency, benchmark_report_writing,\
+        print_answer_benchmark, print_grading_benchmark,\
+        print_import_benchmark, print_latency_benchmark,\
+        print_reading_benchmark, print_writing_benchmark
 from src.services.bot import Bot
+from src.services.db import DataBase
+from src.services.diagnostics import print_query_plans,\
+        print_startup_profile, profile_startup
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--explain-queries', action='store_true',\
+            help='explain database queries, flag collection scans and exit')
+    parser.add_argument('--benchmark-import', type=int, metavar='STUDENTS',\
+            help='measure import of a graded workbook in a separate database and exit')
+    parser.add_argument('--benchmark-answers', type=int, nargs='*', metavar='STUDENTS',\
+            help='measure latency of a saved answer for 30, 100, 300 or the given group sizes in a separate database and exit')
+    parser.add_argument('--benchmark-report-latency', type=int, metavar='STUDENTS',\
+            help='measure answer latency while a report is written in a separate database and exit')
+    parser.add_argument('--benchmark-excel', type=int, metavar='STUDENTS',\
+            help='measure reading of large workbooks by every reader and exit')
+    parser.add_argument('--benchmark-report', type=int, nargs='?', const=300, metavar='STUDENTS',\
+            help='measure writing of a report for 300 or the given number of students and exit')
+    parser.add_argument('--benchmark-grading', type=int, nargs='?', const=200, metavar='STUDENTS',\
+            help='compare per-answer and batched grading for 200 or the given number of students and exit')
+    parser.add_argument('--profile-startup', action='store_true',\
+            help='report import time per package, fail if over the startup budget')
+    parser.add_argument('--migrate-student-tests', action='store_true',\
+            help='move student tests out of written test documents and exit')
+    args = parser.parse_args()
+
+    if args.benchmark_report is not None:
+        print_writing_benchmark(benchmark_report_writing(args.benchmark_report))
+        sys.exit(0)
+
+    if args.benchmark_grading is not None:
+        print_grading_benchmark(benchmark_grading(args.benchmark_grading))
+        sys.exit(0)
+
+    if args.profile_startup:
+        profile = profile_startup()
+        print_startup_profile(profile)
+        sys.exit(1 if profile.is_over_budget else 0)
+
+    if args.benchmark_excel is not None:
+        print_reading_benchmark(benchmark_excel_reading(args.benchmark_excel))
+        sys.exit(0)
+
     dotenv.load_dotenv()
     env = os.environ
     mandatory_vars = [
@@ -22,8 +73,52 @@ def main() -> None:
     # Для локального подъёма закомментить mandatory_vars и заменить db_uri на
     # db_uri = f'mongodb://{env["MONGODB_HOST"]}:27017/{env["MONGODB_DATABASE"]}?authSource=admin'
     
-    bot = Bot(env['TELEGRAM_TOKEN'], db_uri)
-    bot.idle()
+    if args.explain_queries:
+        plans = DataBase(db_uri).explain_queries()
+        print_query_plans(plans)
+        sys.exit(1 if any(plan.is_collection_scan for plan in plans) else 0)
+
+    # docker compose passes unset variables as empty strings
+    written_storage = env.get('WRITTEN_TEST_STORAGE') or WRITTEN_TEST_STORAGE
+
+    if args.migrate_student_tests:
+        count = DataBase(db_uri).migrate_to_student_tests()
+        print(f'Migrated {count} written tests')
+        sys.exit(0)
+
+    if args.benchmark_import is not None:
+        # the benchmark clears its database, never run it on the real one
+        env['MONGODB_DATABASE'] += '-benchmark'
+        print_import_benchmark(benchmark_import(DataBase(db_uri, written_storage), args.benchmark_import))
+        sys.exit(0)
+
+    if args.benchmark_answers is not None:
+        env['MONGODB_DATABASE'] += '-benchmark'
+        db = DataBase(db_uri, written_storage)
+        print_answer_benchmark(benchmark_answer_latency(db, args.benchmark_answers or [30, 100, 300]))
+        db.shutdown()
+        sys.exit(0)
+
+    if args.benchmark_report_latency is not None:
+        env['MONGODB_DATABASE'] += '-benchmark'
+        db = DataBase(db_uri, written_storage)
+        print_latency_benchmark(benchmark_report_latency(db, args.benchmark_report_latency))
+        db.shutdown()
+        sys.exit(0)
+
+    # TELEGRAM_API_URL и TELEGRAM_FILE_URL позволяют направить бота на локальный Bot API, например, для тестов
+    bot = Bot(env['TELEGRAM_TOKEN'], db_uri,\
+            env.get('TELEGRAM_API_URL'), env.get('TELEGRAM_FILE_URL'),\
+            int(env.get('UPDATE_QUEUE_SIZE') or UPDATE_QUEUE_SIZE),\
+            int(env.get('DISPATCH_WORKERS') or DISPATCH_WORKERS),\
+            written_storage)
+
+    if env.get('TELEGRAM_WEBHOOK_URL'):
+        bot.idle_webhook(env.get('WEBHOOK_LISTEN') or WEBHOOK_LISTEN,\
+                int(env.get('WEBHOOK_PORT') or WEBHOOK_PORT),\
+                env['TELEGRAM_WEBHOOK_URL'])
+    else:
+        bot.idle()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+from typing import Any, Union
+
+
+@dataclass
+class DialogRecord:
+    user_id: int # same as telegram id
+    state: str # DialogState value
+    question_index: int = 0
+    test_id: Union[Any, None] = None
+    written_test_id: Union[Any, None] = None
+    group_id: Union[Any, None] = None
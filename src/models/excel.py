@@ -1,3 +1,4 @@
+import io
 from dataclasses import dataclass
 from typing import Union
 
@@ -44,6 +45,11 @@ class WrittenTestExcel:
     variants: list[WrittenTestVariantSheet]
     summary: WrittenTestSummarySheet
 
+@dataclass
+class ExcelReport:
+    filename: str # name of the file without folders
+    content: io.BytesIO
+
 @dataclass
 class UpdatedStudentData:
     name: str
@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+from typing import Any, Union
+
+from .test import StudentWrittenTest, Test, WrittenTest
+
+
+@dataclass
+class TestSession:
+    written_test: WrittenTest
+    test: Test
+    students: dict[int, StudentWrittenTest] # student id -> student test
+
+@dataclass
+class ActiveSession:
+    written_test_id: Any
+    tutor_id: int
+    student_ids: set[int] # students who have not finished yet
+    deadline: Union[float, None] = None # unix time
+    question_time_limit: Union[float, None] = None # seconds
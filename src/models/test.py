@@ -1,4 +1,5 @@
-from typing import Union
+from typing import Callable, Union
+import threading
 import uuid
 from dataclasses import dataclass
 from enum import Enum
@@ -14,6 +15,13 @@ class TestAnswerType(Enum):
 
 TestAnswerValue = Union[str, int, list[int]]
 
+@dataclass
+class AnswerKey:
+    """Question answer compiled for fast checking"""
+    text: Union[str, None] # normalized reference text of LECTURE question
+    mask: int # bit i is set if variant i + 1 is correct
+    variant_count: int
+
 @dataclass
 class RawTestQuestion:
     type: TestAnswerType
@@ -25,6 +33,7 @@ class RawTestQuestion:
 @dataclass
 class TestQuestion(RawTestQuestion):
     id: uuid.UUID
+    key: Union[AnswerKey, None] = None
 
 # endregion
 
@@ -52,6 +61,48 @@ class Test(RawTest):
     id: uuid.UUID
     name: str
     variants: list[TestVariant]
+    content_hash: Union[str, None] = None # sha256 of the uploaded file
+
+class LazyTest(Test):
+    """Test which decodes its variants on the first access"""
+
+    def __init__(self,
+            filename: str,
+            id: uuid.UUID,
+            name: str,
+            load_variants: Callable[[], list[TestVariant]],
+            content_hash: Union[str, None] = None) -> None:
+        self.filename = filename
+        self.id = id
+        self.name = name
+        self.content_hash = content_hash
+        self.__load_variants: Union[Callable[[], list[TestVariant]], None] = load_variants
+        self.__variants: Union[list[TestVariant], None] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def variants(self) -> list[TestVariant]:
+        if self.__variants is None:
+            # the test is shared by handlers, it is decoded once
+            with self.__lock:
+                if self.__variants is None:
+                    self.__variants = self.__load_variants()
+                    # the loader holds the raw document of the test
+                    self.__load_variants = None
+        return self.__variants
+
+    @variants.setter
+    def variants(self, value: list[TestVariant]) -> None:
+        self.__variants = value
+        self.__load_variants = None
+
+@dataclass
+class TestSummary:
+    """Test without questions, for menus and reports"""
+    id: uuid.UUID
+    name: str
+    filename: str
+    variant_count: int
 
 # endregion
 
@@ -0,0 +1,98 @@
+import threading
+from typing import Any, Union
+
+from pymongo import database
+
+from config import ACTIVE_SESSION_COLLECTION_NAME
+
+from ..models.session import ActiveSession
+
+
+class ActiveSessionsTable():
+    """
+    Registry of written tests which are running.
+
+    Indexes sessions by written test and by student, so that answers are
+    routed to the session of the student without scanning. Sessions are
+    stored in the database and loaded on start, running tests survive
+    restarts of the bot.
+    """
+
+    def __init__(self,
+            db: database.Database) -> None:
+        self.__collection = db[ACTIVE_SESSION_COLLECTION_NAME]
+        self.__sessions: dict[Any, ActiveSession] = dict()
+        self.__students: dict[int, ActiveSession] = dict()
+        self.__lock = threading.Lock()
+        self.__load()
+
+    def register(self, session: ActiveSession) -> None:
+        with self.__lock:
+            busy = [id for id in session.student_ids if id in self.__students]
+            if len(busy) > 0:
+                raise Exception(f'Students {busy} are already writing a test')
+            self.__collection.insert_one(self.__to_document(session))
+            self.__add(session)
+
+    def get(self, written_test_id: Any) -> Union[ActiveSession, None]:
+        return self.__sessions.get(written_test_id)
+
+    def get_by_student(self, student_id: int) -> Union[ActiveSession, None]:
+        return self.__students.get(student_id)
+
+    def get_by_tutor(self, tutor_id: int) -> Union[ActiveSession, None]:
+        """Returns the earliest started session of the tutor"""
+        with self.__lock:
+            return next((session for session in self.__sessions.values()\
+                    if session.tutor_id == tutor_id), None)
+
+    def get_all(self) -> list[ActiveSession]:
+        with self.__lock:
+            return list(self.__sessions.values())
+
+    def release_student(self, written_test_id: Any, student_id: int) -> None:
+        """Removes the student from the session, e.g. when he has finished"""
+        with self.__lock:
+            session = self.__sessions.get(written_test_id)
+            if session is None or student_id not in session.student_ids: return
+            session.student_ids.remove(student_id)
+            self.__students.pop(student_id, None)
+            self.__collection.update_one({ 'written_test_id': written_test_id },\
+                    { '$pull': { 'student_ids': student_id } })
+
+    def unregister(self, written_test_id: Any) -> None:
+        with self.__lock:
+            session = self.__sessions.pop(written_test_id, None)
+            if session is None: return
+            for student_id in session.student_ids:
+                self.__students.pop(student_id, None)
+            self.__collection.delete_one({ 'written_test_id': written_test_id })
+
+    def remove_all(self) -> None:
+        with self.__lock:
+            self.__sessions.clear()
+            self.__students.clear()
+            self.__collection.delete_many({})
+
+    def __load(self) -> None:
+        for doc in self.__collection.find():
+            self.__add(self.__from_document(doc))
+
+    def __add(self, session: ActiveSession) -> None:
+        self.__sessions[session.written_test_id] = session
+        for student_id in session.student_ids:
+            self.__students[student_id] = session
+
+    def __to_document(self, session: ActiveSession) -> dict:
+        return { 'written_test_id': session.written_test_id,\
+                'tutor_id': session.tutor_id,\
+                'student_ids': list(session.student_ids),\
+                'deadline': session.deadline,\
+                'question_time_limit': session.question_time_limit }
+
+    def __from_document(self, doc: dict) -> ActiveSession:
+        return ActiveSession(doc['written_test_id'],\
+                doc['tutor_id'],\
+                set(doc['student_ids']),\
+                doc.get('deadline'),\
+                doc.get('question_time_limit'))
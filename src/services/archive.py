@@ -0,0 +1,38 @@
+import pathlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ARCHIVE_FILES, RUNTIME_FOLDER
+
+
+class FileArchive():
+    """
+    Copies uploaded files and reports to RUNTIME_FOLDER in background.
+
+    Files are processed in memory, the archive only keeps copies for the
+    tutor and is never read back by the bot. A file with a taken name gets
+    a number, so reports of tests finished at the same second are kept.
+    """
+
+    def __init__(self, enabled: bool = ARCHIVE_FILES) -> None:
+        self.__enabled = enabled
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix='archive')
+
+    def save(self, subpath: str, name: str, content: bytes) -> None:
+        if not self.__enabled: return
+        self.__executor.submit(self.__write, f'{RUNTIME_FOLDER}/{subpath}/{name}', content)
+
+    def shutdown(self) -> None:
+        self.__executor.shutdown(wait=True)
+
+    def __write(self, filename: str, content: bytes) -> None:
+        try:
+            path = pathlib.Path(filename)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            number = 1
+            while path.exists():
+                path = path.with_name(f'{pathlib.Path(filename).stem} ({number}){path.suffix}')
+                number += 1
+            path.write_bytes(content)
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,460 @@
+import multiprocessing
+import pathlib
+import resource
+import statistics
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Union, cast
+
+import Levenshtein
+
+from config import RUNTIME_FOLDER, TESTS_FOLDERNAME, WRITTEN_TESTS_FOLDERNAME
+
+from ..models.excel import WrittenTestExcel, WrittenTestGroup,\
+        WrittenTestQuestionData, WrittenTestStudentAnswer,\
+        WrittenTestStudentData, WrittenTestSummarySheet,\
+        WrittenTestVariantSheet
+from ..models.group import RawGroup
+from ..models.test import RawTest, StudentWrittenTest, TestAnswer,\
+        TestAnswerType, TestAnswerValue, TestQuestion
+from ..models.user import RawStudent
+from .db import DataBase
+from .excels import ExcelService
+from .grading import BatchGrader, GradingItem, compile_key
+
+
+# telegram ids of synthetic students start here to stay clear of real ones
+BENCHMARK_STUDENT_ID = 10 ** 12
+
+
+@dataclass
+class ReadingBenchmark:
+    reader: str
+    filename: str
+    duration: float # seconds
+    peak_rss: int # KiB, maximum resident set size of the process
+    base_rss: int # KiB, resident set size before reading
+
+@dataclass
+class WritingBenchmark:
+    constant_memory: bool
+    duration: float # seconds
+    peak_rss: int # KiB, maximum resident set size of the process
+    base_rss: int # KiB, resident set size before writing
+    file_size: int # bytes
+
+@dataclass
+class ImportBenchmark:
+    student_count: int
+    question_count: int
+    answer_duration: float # seconds of all save_answer calls
+    durations: list[float] # seconds of each post_finished call
+
+@dataclass
+class GradingBenchmark:
+    student_count: int
+    question_count: int
+    per_answer: float # seconds of grading every answer as save_answer did before batching
+    batched: float # seconds of grading all answers by one call
+
+@dataclass
+class AnswerBenchmark:
+    group_size: int
+    latencies: list[float] # seconds of each save_answer call
+
+@dataclass
+class LatencyBenchmark:
+    mode: str
+    report_duration: float # seconds from finish to written report
+    latencies: list[float] # seconds of save_answer calls while the report was written
+
+
+def benchmark_import(db: DataBase,
+        student_count: int,
+        variant_count: int = 4,
+        question_count: int = 10,
+        group_size: int = 30,
+        repeats: int = 3) -> ImportBenchmark:
+    """
+    Measures saving of answers and import of a graded workbook by
+    post_finished.
+
+    Fills the database with synthetic groups, students and a test, writes
+    the test and grades it, then imports the graded workbook. The database
+    is cleared before and after the run.
+    """
+    db.clear_database()
+
+    group_count = (student_count + group_size - 1) // group_size
+    groups = db.groups.create_many([RawGroup(f'Группа {i + 1}') for i in range(group_count)])
+    students = db.users.create_students([\
+            RawStudent(BENCHMARK_STUDENT_ID + i, f'Студент {i + 1}', groups[i // group_size].id)\
+            for i in range(student_count)])
+
+    test = db.tests.create(RawTest(write_benchmark_test(variant_count, question_count)))
+    written_test = db.tests.start(test.id, [student.id for student in students])
+    start = time.perf_counter()
+    for student_test in written_test.student_tests:
+        variant = db.tests.get_variant(test.id, 'id', student_test.variant_id)
+        for question in variant.questions:
+            db.tests.save_answer(student_test.student_id, written_test.id, question.id, 'ответ')
+    answer_duration = time.perf_counter() - start
+    report = db.tests.finish(written_test.id)
+
+    durations: list[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        report.content.seek(0)
+        db.tests.post_finished(report.filename, report.content)
+        durations.append(time.perf_counter() - start)
+
+    db.clear_database()
+    return ImportBenchmark(student_count, question_count, answer_duration, durations)
+
+
+def benchmark_grading(student_count: int = 200,
+        question_count: int = 10,
+        repeats: int = 3) -> GradingBenchmark:
+    """
+    Compares the grading of save_answer before batching, which checked
+    every answer by Levenshtein.ratio or a comparison of choices, with
+    grading all answers of a test by one batch. Questions are lecture,
+    single and multiple choice ones in turn.
+    """
+    types = [TestAnswerType.LECTURE, TestAnswerType.SINGLE_CHOICE, TestAnswerType.MULTIPLE_CHOICE]
+    questions: list[TestQuestion] = []
+    for i in range(question_count):
+        type = types[i % len(types)].value
+        if type == TestAnswerType.LECTURE.value:
+            question = TestQuestion(type, f'Вопрос {i + 1}', None,\
+                    'принятие решений в условиях неопределённости', 1, uuid.uuid4())
+        elif type == TestAnswerType.SINGLE_CHOICE.value:
+            question = TestQuestion(type, f'Вопрос {i + 1}', ['1', '2', '3', '4'], 2, 1, uuid.uuid4())
+        else:
+            question = TestQuestion(type, f'Вопрос {i + 1}', ['1', '2', '3', '4'], [1, 3], 1, uuid.uuid4())
+        question.key = compile_key(question)
+        questions.append(question)
+
+    values = { TestAnswerType.LECTURE.value: ['принятие решений', 'решения в условиях риска', 'не знаю'],\
+            TestAnswerType.SINGLE_CHOICE.value: ['1', '2', '3'],\
+            TestAnswerType.MULTIPLE_CHOICE.value: ['1, 3', '2', '1, 2, 4'] }
+
+    def build_items() -> list[GradingItem]:
+        items: list[GradingItem] = []
+        for i in range(student_count):
+            student_test = StudentWrittenTest(uuid.uuid4(), None, BENCHMARK_STUDENT_ID + i, uuid.uuid4(), [], None)
+            for question in questions:
+                value = values[question.type][i % 3]
+                answer = TestAnswer(uuid.uuid4(), question.id, value, None)
+                student_test.answers.append(answer)
+                items.append(GradingItem(student_test, question, answer))
+        return items
+
+    # save_answer passed raw text, the check of multiple choice expected
+    # a list of variant numbers and failed on text
+    baseline_answers = []
+    for item in build_items():
+        value = item.answer.value
+        if item.question.type == TestAnswerType.MULTIPLE_CHOICE.value:
+            value = [int(number) for number in str(value).split(',')]
+        baseline_answers.append((item.question, value))
+
+    grader = BatchGrader()
+    per_answer: list[float] = []
+    batched: list[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for question, value in baseline_answers:
+            check_answer_baseline(question, value)
+        per_answer.append(time.perf_counter() - start)
+
+        batch_items = build_items()
+        start = time.perf_counter()
+        grader.grade(batch_items)
+        batched.append(time.perf_counter() - start)
+
+    return GradingBenchmark(student_count, question_count, min(per_answer), min(batched))
+
+
+def check_answer_baseline(question: TestQuestion, answer: TestAnswerValue) -> Union[float, None]:
+    """Check of a single answer which save_answer used before batching"""
+    if question.type == TestAnswerType.LECTURE.value:
+        return Levenshtein.ratio(\
+                cast(str, question.answer),\
+                cast(str, answer))
+
+    if question.type == TestAnswerType.SINGLE_CHOICE.value:
+        return int(question.answer == answer)
+
+    if question.type == TestAnswerType.MULTIPLE_CHOICE.value:
+        if question.answer_variants is None:
+            raise Exception('Cannot check answer. Answer variants' +\
+                    ' are not provided for a MULTIPLE_CHOICE question.')
+
+        correct_answers = []
+        student_answers = []
+        for i in range(len(question.answer_variants)):
+            correct_answers.append(i + 1 in cast(list[int], question.answer))
+            student_answers.append(i in cast(list[int], answer))
+        variant_count = len(question.answer_variants)
+        student_count = 0
+        for i in range(variant_count):
+            if correct_answers[i] == student_answers[i]:
+                student_count += 1
+        return student_count / variant_count
+
+    return None
+
+
+def print_grading_benchmark(result: GradingBenchmark) -> None:
+    answer_count = result.student_count * result.question_count
+    print(f'{result.student_count} students, {result.question_count} questions, best of runs:')
+    print(f'per answer: {result.per_answer:.3f}s ({result.per_answer / answer_count * 1000000:.1f}us per answer)')
+    print(f'batched: {result.batched:.3f}s ({result.batched / answer_count * 1000000:.1f}us per answer), ' +\
+            f'speedup {result.per_answer / result.batched:.2f}x')
+
+
+def benchmark_answer_latency(db: DataBase,
+        group_sizes: list[int],
+        question_count: int = 10) -> list[AnswerBenchmark]:
+    """
+    Measures latency of a single save_answer call against the number of
+    students writing the test. The database is cleared before and after
+    every run.
+    """
+    results: list[AnswerBenchmark] = []
+    for group_size in group_sizes:
+        db.clear_database()
+        group = db.groups.create_many([RawGroup('Группа')])[0]
+        students = db.users.create_students([\
+                RawStudent(BENCHMARK_STUDENT_ID + i, f'Студент {i + 1}', group.id)\
+                for i in range(group_size)])
+        test = db.tests.create(RawTest(write_benchmark_test(4, question_count)))
+        written_test = db.tests.start(test.id, [student.id for student in students])
+
+        latencies: list[float] = []
+        for student_test in written_test.student_tests:
+            variant = db.tests.get_variant(test.id, 'id', student_test.variant_id)
+            for question in variant.questions:
+                start = time.perf_counter()
+                db.tests.save_answer(student_test.student_id, written_test.id, question.id, 'ответ')
+                latencies.append(time.perf_counter() - start)
+        results.append(AnswerBenchmark(group_size, latencies))
+
+    db.clear_database()
+    return results
+
+
+def print_answer_benchmark(results: list[AnswerBenchmark]) -> None:
+    for result in results:
+        latencies = sorted(result.latencies)
+        print(f'{result.group_size} students: {len(latencies)} answers, ' +\
+                f'median {statistics.median(latencies) * 1000:.2f}ms, ' +\
+                f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms, ' +\
+                f'max {latencies[-1] * 1000:.2f}ms')
+
+
+def benchmark_report_latency(db: DataBase,
+        student_count: int,
+        question_count: int = 10,
+        writer_count: int = 20,
+        interval: float = 0.005) -> list[LatencyBenchmark]:
+    """
+    Measures save_answer latency while a report is written, once with the
+    report written in the finishing thread and once in a worker process.
+
+    A test of student_count students is finished while writer_count
+    students of another test answer every interval seconds. The database
+    is cleared before and after every run.
+    """
+    results: list[LatencyBenchmark] = []
+    for mode in ['thread', 'process']:
+        db.clear_database()
+        group = db.groups.create_many([RawGroup('Группа')])[0]
+        students = db.users.create_students([\
+                RawStudent(BENCHMARK_STUDENT_ID + i, f'Студент {i + 1}', group.id)\
+                for i in range(student_count + writer_count)])
+        test = db.tests.create(RawTest(write_benchmark_test(4, question_count)))
+
+        finished = db.tests.start(test.id, [student.id for student in students[:student_count]])
+        for student_test in finished.student_tests:
+            variant = db.tests.get_variant(test.id, 'id', student_test.variant_id)
+            for question in variant.questions:
+                db.tests.save_answer(student_test.student_id, finished.id, question.id, 'ответ')
+        writing = db.tests.start(test.id, [student.id for student in students[student_count:]])
+        questions = [(student_test.student_id, question.id)\
+                for student_test in writing.student_tests\
+                for question in db.tests.get_variant(test.id, 'id', student_test.variant_id).questions]
+
+        done = threading.Event()
+        start = time.perf_counter()
+        if mode == 'thread':
+            def finish() -> None:
+                try:
+                    db.tests.finish(finished.id)
+                finally:
+                    done.set()
+            threading.Thread(target=finish).start()
+        else:
+            db.tests.finish_in_background(finished.id, lambda _: done.set())
+
+        latencies: list[float] = []
+        while not done.is_set():
+            student_id, question_id = questions[len(latencies) % len(questions)]
+            answer_start = time.perf_counter()
+            db.tests.save_answer(student_id, writing.id, question_id, 'ответ')
+            latencies.append(time.perf_counter() - answer_start)
+            time.sleep(interval)
+        results.append(LatencyBenchmark(mode, time.perf_counter() - start, latencies))
+
+    db.clear_database()
+    return results
+
+
+def print_latency_benchmark(results: list[LatencyBenchmark]) -> None:
+    for result in results:
+        latencies = sorted(result.latencies)
+        if len(latencies) == 0:
+            print(f'{result.mode}: report in {result.report_duration:.3f}s, no answers saved meanwhile')
+            continue
+        print(f'{result.mode}: report in {result.report_duration:.3f}s, ' +\
+                f'{len(latencies)} answers saved meanwhile, ' +\
+                f'median {statistics.median(latencies) * 1000:.2f}ms, ' +\
+                f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms, ' +\
+                f'max {latencies[-1] * 1000:.2f}ms')
+
+
+def write_benchmark_test(variant_count: int, question_count: int) -> str:
+    """Writes a test template with lecture questions, returns its filename"""
+    import pandas as pd
+
+    pathlib.Path(f'{RUNTIME_FOLDER}/{TESTS_FOLDERNAME}').mkdir(parents=True, exist_ok=True)
+    filename = f'{RUNTIME_FOLDER}/{TESTS_FOLDERNAME}/Бенчмарк.xlsx'
+    with pd.ExcelWriter(filename) as writer:
+        for i in range(variant_count):
+            rows = [{ 'вопрос': f'Вопрос {j + 1}',\
+                    'тип ответа': TestAnswerType.LECTURE.value,\
+                    'ответ': 'ответ',\
+                    'макс балл': 1 } for j in range(question_count)]
+            pd.DataFrame(rows).to_excel(writer, sheet_name=f'Вариант {i + 1}', index=False)
+    return filename
+
+
+def print_import_benchmark(result: ImportBenchmark) -> None:
+    answer_count = result.student_count * result.question_count
+    print(f'save_answer: {answer_count} answers in {result.answer_duration:.3f}s ' +\
+            f'({result.answer_duration / answer_count * 1000:.2f}ms per answer)')
+    best = min(result.durations)
+    print(f'post_finished: {result.student_count} students, ' +\
+            f'{result.question_count} questions, best of {len(result.durations)}: ' +\
+            f'{best:.3f}s ({best / result.student_count * 1000:.2f}ms per student)')
+
+
+def benchmark_excel_reading(student_count: int,
+        variant_count: int = 4,
+        question_count: int = 50) -> list[ReadingBenchmark]:
+    """
+    Measures parse time and memory of a test template and of a graded
+    workbook with every reader. Every file is read in a new process, so
+    that peak memory of one read does not hide the others.
+    """
+    test_filename = write_benchmark_test(variant_count, question_count * 10)
+    written_filename = write_benchmark_written_test(student_count, variant_count, question_count)
+
+    results: list[ReadingBenchmark] = []
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for reader in ['openpyxl', 'pandas']:
+            for filename, is_test in [(test_filename, True), (written_filename, False)]:
+                results.append(pool.apply(measure_reading, (reader, filename, is_test)))
+    return results
+
+
+def measure_reading(reader: str, filename: str, is_test: bool) -> ReadingBenchmark:
+    base_rss = get_peak_rss()
+    service = ExcelService(reader)
+    start = time.perf_counter()
+    if is_test:
+        service.read_test(RawTest(filename))
+    else:
+        service.read_written_test(filename)
+    duration = time.perf_counter() - start
+    peak_rss = get_peak_rss()
+    return ReadingBenchmark(reader, filename, duration, peak_rss, base_rss)
+
+
+def get_peak_rss() -> int:
+    """Returns peak resident set size of the process in KiB"""
+    # ru_maxrss of a spawned process starts from the parent's peak on Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_benchmark_written_test(student_count: int,
+        variant_count: int,
+        question_count: int) -> str:
+    """Writes a graded workbook with long answers, returns its filename"""
+    excel = build_benchmark_written_test(student_count, variant_count, question_count)
+    return ExcelService().write_written_test(excel)
+
+
+def build_benchmark_written_test(student_count: int,
+        variant_count: int,
+        question_count: int) -> WrittenTestExcel:
+    pathlib.Path(f'{RUNTIME_FOLDER}/{WRITTEN_TESTS_FOLDERNAME}').mkdir(parents=True, exist_ok=True)
+    questions = [WrittenTestQuestionData(f'Вопрос {j + 1}', 'ответ', 1) for j in range(question_count)]
+    students = [WrittenTestStudentData(f'Студент {i + 1}', 'Группа', BENCHMARK_STUDENT_ID + i,\
+            [WrittenTestStudentAnswer('длинный ответ ' * 20, 0.5) for _ in range(question_count)])\
+            for i in range(student_count)]
+    variants = [WrittenTestVariantSheet(f'Вариант {i + 1}', questions, students[i::variant_count])\
+            for i in range(variant_count)]
+    summary = WrittenTestSummarySheet([WrittenTestGroup('Группа', students)])
+    return WrittenTestExcel('Бенчмарк', '2000-01-01 00-00-00', variants, summary)
+
+
+def print_reading_benchmark(results: list[ReadingBenchmark]) -> None:
+    for result in results:
+        print(f'{result.reader}: {pathlib.Path(result.filename).name} in {result.duration:.3f}s, ' +\
+                f'peak RSS {result.peak_rss // 1024} MiB ({(result.peak_rss - result.base_rss) // 1024} MiB while reading)')
+
+
+def benchmark_report_writing(student_count: int = 300,
+        variant_count: int = 4,
+        question_count: int = 10) -> list[WritingBenchmark]:
+    """
+    Measures write time, memory and file size of a report with and
+    without constant memory mode, every report is written in a new process.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return [pool.apply(measure_writing, (constant_memory, student_count, variant_count, question_count))\
+                for constant_memory in [False, True]]
+
+
+def measure_writing(constant_memory: bool,
+        student_count: int,
+        variant_count: int,
+        question_count: int) -> WritingBenchmark:
+    excel = build_benchmark_written_test(student_count, variant_count, question_count)
+    service = ExcelService(constant_memory=constant_memory)
+    base_rss = get_peak_rss()
+    start = time.perf_counter()
+    report = service.write_report(excel)
+    duration = time.perf_counter() - start
+    peak_rss = get_peak_rss()
+    return WritingBenchmark(constant_memory, duration, peak_rss, base_rss, len(report.content.getbuffer()))
+
+
+def print_writing_benchmark(results: list[WritingBenchmark]) -> None:
+    for result in results:
+        mode = 'constant memory' if result.constant_memory else 'in memory'
+        print(f'{mode}: written in {result.duration:.3f}s, {result.file_size // 1024} KiB, ' +\
+                f'peak RSS {result.peak_rss // 1024} MiB ({(result.peak_rss - result.base_rss) // 1024} MiB while writing)')
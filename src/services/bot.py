@@ -1,33 +1,103 @@
+import io
+import threading
+import time
+from queue import Queue
+from urllib.parse import urlparse
+
 import telegram as tg
 import telegram.ext as tg_ext
+import telegram.utils.request as tg_request
+
+from typing import Union
 
-from config import RUNTIME_FOLDER, TESTS_FOLDERNAME, WRITTEN_TESTS_FOLDERNAME
+from config import BROADCAST_WORKERS, DEADLINE_TICK, DISPATCH_WORKERS,\
+        QUESTION_TIME_LIMIT, TEST_TIME_LIMIT,\
+        TESTS_FOLDERNAME, UPDATE_QUEUE_SIZE, UPDATER_WORKERS,\
+        WRITTEN_TEST_STORAGE, WRITTEN_TESTS_FOLDERNAME
 
+from ..models.excel import ExcelReport
+from ..models.dialog import DialogRecord
+from ..models.session import ActiveSession
 from ..models.test import RawTest
 from ..models.user import RawStudent
 from ..models.group import RawGroup
 
+from .broadcast import Broadcaster
 from .db import DataBase
-from .dialogs import TEST_QUESTION_ID, StudentSettingsBranch, TutorCheckBranch,\
-        TutorSettingsBranch, TutorSettingsClearDatabaseOptions, TutorTestBranch, TutorTestSuccessOptions,\
-        student_abort_test, student_check_branch, student_exists_branch,\
-        student_settings_branch, student_test_branch, tutorStartDialog
+from .deadlines import TimerWheel
+from .dialog_data import DataBaseDialogData
+from .dispatch import UserDispatcher
+from .dialogs import DIALOG_STATES, DialogAnswer, DialogState,\
+        TutorSettingsClearDatabaseOptions, TutorTestSuccessOptions,\
+        broadcast_report, report_failed, report_preparing,\
+        test_no_students, test_skipped_students
 
 class Bot:
 
-    def __init__(self, token: str, db_url: str) -> None:
-
-        self.__updater = tg_ext.Updater(token=token)
-        self.__dispatcher = self.__updater.dispatcher
-        self.__db = DataBase(db_url)
-        self.__dialogs = dict([(user.id, dict()) for user in self.__db.users.get_users()])
-        self.__rawStudents = dict()
+    def __init__(self,
+            token: str,
+            db_url: str,
+            base_url: Union[str, None] = None,
+            base_file_url: Union[str, None] = None,
+            update_queue_size: int = UPDATE_QUEUE_SIZE,
+            workers: int = DISPATCH_WORKERS,
+            written_storage: str = WRITTEN_TEST_STORAGE) -> None:
+
+        self.__request = tg_request.Request(\
+                con_pool_size=UPDATER_WORKERS + workers + BROADCAST_WORKERS + 4)
+        bot = tg_ext.ExtBot(token, base_url, base_file_url, request=self.__request)
+        job_queue = tg_ext.JobQueue()
+        self.__dispatcher = tg_ext.Dispatcher(bot, Queue(update_queue_size),\
+                workers=UPDATER_WORKERS, job_queue=job_queue)
+        job_queue.set_dispatcher(self.__dispatcher)
+        self.__updater = tg_ext.Updater(dispatcher=self.__dispatcher, workers=None)
+
+        self.__broadcaster = Broadcaster(bot)
+        self.__user_dispatcher = UserDispatcher(workers, update_queue_size)
+        self.__db = DataBase(db_url, written_storage)
+        self.__dialog_data = DataBaseDialogData(self.__db)
+
+        # ('test', written test id) and ('question', student id) deadlines
+        self.__deadlines = TimerWheel(time.time())
+        self.__restore_deadlines()
+        job_queue.run_repeating(self.__check_deadlines, DEADLINE_TICK)
+
+        # Dialog of a user is changed either by his own updates or by tutor's
+        # actions, both hold the user's dialog lock
+        self.__dialog_locks: dict[int, threading.RLock] = dict()
+        self.__dialog_locks_lock = threading.Lock()
+
+        # Side effects of user's reply, by the state the user has replied in
+        self.__state_handlers = {
+                DialogState.TUTOR_ENTER_GROUPS: self.__enter_groups,
+                DialogState.TUTOR_ENTER_TESTS: self.__enter_tests,
+                DialogState.TUTOR_MORE_TESTS: self.__enter_tests,
+                DialogState.TUTOR_CLEAR_DATABASE: self.__clear_database,
+                DialogState.TUTOR_SELECT_TEST: self.__select_test,
+                DialogState.TUTOR_SELECT_GROUP: self.__start_test,
+                DialogState.TUTOR_TEST_STARTED: self.__stop_test,
+                DialogState.TUTOR_TEST_RUNNING: self.__stop_test,
+                DialogState.TUTOR_SEND_FILE: self.__check_test,
+                DialogState.STUDENT_SELECT_GROUP: self.__select_student_group,
+                DialogState.STUDENT_ENTER_FIO: self.__enter_fio,
+                DialogState.STUDENT_QUESTION: self.__save_answer,
+                }
 
         self.__register_handlers()
 
     def __register_handlers(self) -> None:
-        self.__dispatcher.add_handler(tg_ext.CommandHandler('start', self.__start_command_handler))
-        self.__dispatcher.add_handler(tg_ext.MessageHandler(tg_ext.Filters.text | tg_ext.Filters.document, self.__message_handler))
+        self.__dispatcher.add_handler(tg_ext.CommandHandler('start', self.__dispatch(self.__start_command_handler)))
+        self.__dispatcher.add_handler(tg_ext.MessageHandler(tg_ext.Filters.text | tg_ext.Filters.document, self.__dispatch(self.__message_handler)))
+
+    def __dispatch(self, handler):
+        """Wraps handler to run it in the chat's queue of the user dispatcher"""
+        def callback(update: tg.Update, context: tg_ext.CallbackContext) -> None:
+            user_id = update.effective_user.id
+            def job():
+                with self.__dialog_lock(user_id):
+                    handler(update, context)
+            self.__user_dispatcher.submit(update.effective_chat.id, job)
+        return callback
 
     #region Command handlers
 
@@ -35,21 +105,11 @@ class Bot:
                                 update: tg.Update,
                                 context: tg_ext.CallbackContext) -> None:
         tg_user = update.effective_user
-        self.__dialogs[tg_user.id] = dict()
 
         if (not self.__db.users.has_tutor()):
             self.__db.users.create_tutor(tg_user.id)
 
-
-        if (self.__db.users.get_user(tg_user.id) != None and self.__db.users.get_user(tg_user.id).is_tutor):
-            self.__dialogs[tg_user.id]['generator'] = tutorStartDialog(self.__db.tests.get_all(), self.__db.groups.get_all())
-        elif (self.__db.users.get_user(tg_user.id) == None):
-            self.__dialogs[tg_user.id]['generator'] = student_settings_branch(self.__db.groups.get_all())
-        else:
-            self.__dialogs[tg_user.id]['generator'] = student_exists_branch()
-        
-        self.__dialogs[tg_user.id]['answer'] = next(self.__dialogs[tg_user.id]['generator'])
-        self.__send_message(context, tg_user.id, self.__dialogs[tg_user.id]['answer'])
+        self.__restart_dialog(context, tg_user.id)
     #endregion
 
     #region Message handler
@@ -60,119 +120,132 @@ class Bot:
         print("\nReceived", update)
         tg_user = update.effective_user
 
-        if not(tg_user.id in self.__dialogs) or not(self.__dialogs[tg_user.id].get('generator', None)):
+        record = self.__db.dialogs.get(tg_user.id)
+        if record is None:
             return self.__start_command_handler(update, context)
+        state = DialogState(record.state)
 
         #handle block
-        previousMessageId = self.__dialogs[tg_user.id]['answer'].text.id
-
-        # Введите группы этого семестра списком (элементы разделяйте переносом строки)
-        if (previousMessageId == TutorSettingsBranch.ENTER_GROUPS.value.id):
-            if update.message.text != '-':
-                for name in update.message.text.split('\n'):
-                    self.__db.groups.create(RawGroup(name))
-        # Загрузите файлы с летучками по этому шаблону. Будьте внимательны, название файла будет названием летучки.
-        # или
-        # Пришлите файл в формате .xlsx
-        elif (previousMessageId in [TutorSettingsBranch.ENTER_TESTS.value.id, TutorSettingsBranch.FILE_FORMAT_ERROR.value.id]):
-            if update.message.document:
-                self.__download_file(update, context, f'{TESTS_FOLDERNAME}/')
-                self.__db.tests.create(RawTest(\
-                    f'{RUNTIME_FOLDER}/{TESTS_FOLDERNAME}/' +\
-                    update.message.document.file_name))
-                return
-        
-        # База успешно очищена, можно заново настраивать бота.
-        elif (previousMessageId == TutorSettingsBranch.CLEAR_DATABASE.value.id):
-            if update.message.text == TutorSettingsClearDatabaseOptions.CONFIRM.value:
-                self.__db.clear_database()
-
-        # Привет!
-        # Из какой ты группы?
-        elif (previousMessageId == StudentSettingsBranch.SELECT_GROUP.value.id):
-            self.__rawStudents[tg_user.id] = RawStudent(tg_user.id, '', self.__db.groups.get('name', update.message.text).id)
-        # Введи своё ФИО
-        elif (previousMessageId == StudentSettingsBranch.ENTER_FIO.value.id):
-            self.__rawStudents[tg_user.id].name = update.message.text
-            self.__db.users.create_student(self.__rawStudents[tg_user.id])
-
-        # Выберите летучку
-        elif (previousMessageId == TutorTestBranch.SELECT_TEST.value.id):
-            self.__testId = self.__db.tests.get('name', update.message.text).id
-        # Выберете группу
-        elif (previousMessageId == TutorTestBranch.SELECT_GROUP.value.id):
-            student_ids = [student.id for student in self.__db.users.get_students(self.__db.groups.get('name', update.message.text).id)]
-            self.__writtenTest = self.__db.tests.start(self.__testId, student_ids)
-            for student_id in student_ids:
-                test_name = self.__db.tests.get('_id', self.__testId).name
-                variant_questions = self.__db.tests.get_variant(self.__testId, 'id', self.__db.tests.get_student(self.__writtenTest.id, 'student_id', student_id).variant_id).questions
-                # FIXME: если студент в текущем запуске бота не общался с ним, вылетает KeyError
-                self.__dialogs[student_id]['generator'] = student_test_branch(test_name, variant_questions)
-                self.__dialogs[student_id]['answer'] = next(self.__dialogs[student_id]['generator'])
-                self.__send_message(context, student_id, self.__dialogs[student_id]['answer'])
-        # Летучка началась
-        # 
-        # Можете остановить летучку кнопкой ниже
-        elif (previousMessageId == TutorTestBranch.SUCCESS.value.id):
-            if (update.message.text == TutorTestSuccessOptions.STOP.value):
-                filename = self.__db.tests.finish(self.__writtenTest.id)
-                with open(filename, 'rb') as f:
-                    context.bot.sendDocument(chat_id=tg_user.id, document=f)
-                student_ids = [test.student_id for test in self.__writtenTest.student_tests]
-                for student_id in student_ids:
-                    self.__dialogs[student_id]['generator'] = student_abort_test()
-                    self.__dialogs[student_id]['answer'] = next(self.__dialogs[student_id]['generator'])
-                    self.__send_message(context, student_id, self.__dialogs[student_id]['answer'])
-                self.__writtenTest == None
-
-
-        # Любой вопрос теста
-        elif (previousMessageId == TEST_QUESTION_ID):
-            student_test = self.__db.tests.get_student(self.__writtenTest.id, 'student_id', tg_user.id)
-            question_id = self.__db.tests.get_question(self.__testId, student_test.variant_id, len(student_test.answers)).id
-            self.__db.tests.save_answer(tg_user.id, self.__writtenTest.id, question_id, update.message.text)
-        
-
-        # Оцените результаты, выставьте баллы в соответствующую графу и пришлите изменённый файл в ответном сообщении
-        elif (previousMessageId == TutorCheckBranch.SEND_FILE.value.id):
-            if update.message.document:
-                self.__download_file(update, context, f'{WRITTEN_TESTS_FOLDERNAME}/')
-                finished_test = self.__db.tests.post_finished(\
-                        f'{RUNTIME_FOLDER}/{WRITTEN_TESTS_FOLDERNAME}/' +\
-                        update.message.document.file_name)
-                test_name = self.__db.tests.get('_id', finished_test.test_id).name
-                for test in finished_test.student_tests:
-                    max_mark = self.__db.tests.get_variant(finished_test.test_id, 'id', test.variant_id).sum_max_mark
-                    student_id = test.student_id
-                    self.__dialogs[student_id]['generator'] = student_check_branch(test_name, test.sum_mark, max_mark)
-                    self.__dialogs[student_id]['answer'] = next(self.__dialogs[student_id]['generator'])
-                    self.__send_message(context, student_id, self.__dialogs[student_id]['answer'])
-                    
-
-
-
-
+        handler = self.__state_handlers.get(state)
+        if handler is not None:
+            handler(update, context, record)
 
         #answer block
-        print('\nUser:', self.__db.users.get_user(tg_user.id))
-        
-        try:
-            self.__dialogs[tg_user.id]['answer'] = self.__dialogs[tg_user.id]['generator'].send(update.message)
-        except StopIteration:
-            self.__restart_dialog(update, context, tg_user.id)
+        next_state = DIALOG_STATES[state].next(record, update.message, self.__dialog_data)
+        if next_state is None:
+            return self.__restart_dialog(context, tg_user.id)
 
-        print("\nAnswer: %r" % self.__dialogs[tg_user.id]['answer'].text.messages)
-        self.__send_message(context, tg_user.id, self.__dialogs[tg_user.id]['answer'])
+        record.state = next_state.value
+        self.__enter_state(context, record)
 
-        #Рестарт диалога, если конец ветки
-        sentMessageId = self.__dialogs[tg_user.id]['answer'].text.id
-        if  (sentMessageId == TutorSettingsBranch.SUCCESS.value.id) or \
-            (sentMessageId == TutorTestBranch.FINISH.value.id) or \
-            (sentMessageId == TutorCheckBranch.SUCCESS.value.id) or \
-            (sentMessageId == TutorSettingsBranch.CLEAR_DATABASE_SUCCESS.value.id) or \
-            (sentMessageId == TutorSettingsBranch.CLEAR_DATABASE_DECLINE.value.id):
-            self.__restart_dialog(update, context, tg_user.id)
+    #endregion
 
+    #region State handlers
+
+    # Введите группы этого семестра списком (элементы разделяйте переносом строки)
+    def __enter_groups(self, update, context, record):
+        if update.message.text != '-':
+            names = update.message.text.split('\n')
+            self.__db.groups.create_many([RawGroup(name) for name in names])
+
+    # Загрузите файлы с летучками по этому шаблону. Будьте внимательны, название файла будет названием летучки.
+    def __enter_tests(self, update, context, record):
+        if update.message.document:
+            file = self.__download_file(update, context, TESTS_FOLDERNAME)
+            self.__db.tests.create(RawTest(update.message.document.file_name), file)
+
+    # Вы точно хотите удалить все данные из базы?
+    def __clear_database(self, update, context, record):
+        if update.message.text == TutorSettingsClearDatabaseOptions.CONFIRM.value:
+            self.__db.clear_database()
+            # the tutor is removed with other users, he stays the tutor
+            self.__db.users.create_tutor(record.user_id)
+
+    # Привет!
+    # Из какой ты группы?
+    def __select_student_group(self, update, context, record):
+        record.group_id = self.__db.groups.get('name', update.message.text).id
+
+    # Введи своё ФИО
+    def __enter_fio(self, update, context, record):
+        self.__db.users.create_student(RawStudent(record.user_id, update.message.text, record.group_id))
+
+    # Выберите летучку
+    def __select_test(self, update, context, record):
+        record.test_id = self.__db.tests.get_summary('name', update.message.text).id
+
+    # Выберете группу
+    def __start_test(self, update, context, record):
+        students = self.__db.users.get_students(self.__db.groups.get('name', update.message.text).id)
+        # students of a group can write only one test at a time
+        student_ids = []
+        skipped_names = []
+        for student in students:
+            if self.__db.active_sessions.get_by_student(student.id) is None:
+                student_ids.append(student.id)
+            else:
+                skipped_names.append(student.name)
+        if len(skipped_names) > 0:
+            self.__send_message(context, record.user_id, test_skipped_students(skipped_names))
+        if len(student_ids) == 0:
+            return self.__send_message(context, record.user_id, test_no_students())
+
+        written_test = self.__db.tests.start(record.test_id, student_ids)
+        deadline = time.time() + TEST_TIME_LIMIT if TEST_TIME_LIMIT is not None else None
+        self.__db.active_sessions.register(ActiveSession(written_test.id, record.user_id,\
+                set(student_ids), deadline, QUESTION_TIME_LIMIT))
+        if deadline is not None:
+            self.__deadlines.schedule(('test', written_test.id), deadline)
+        record.written_test_id = written_test.id
+
+        deliveries = []
+        for student_id in student_ids:
+            student_record = DialogRecord(student_id, DialogState.STUDENT_QUESTION.value,\
+                    written_test_id=written_test.id)
+            deliveries.append((student_id, self.__prepare_state(student_record)))
+        self.__broadcast(context, record.user_id, deliveries)
+
+    # Летучка началась
+    #
+    # Можете остановить летучку кнопкой ниже
+    def __stop_test(self, update, context, record):
+        if update.message.text != TutorTestSuccessOptions.STOP.value:
+            return
+        session = self.__db.active_sessions.get(record.written_test_id)
+        if session is None:
+            return # test has already expired
+        if session.tutor_id != record.user_id:
+            raise Exception('Cannot stop test. Test belongs to another tutor')
+        self.__finish_test(context, session)
+
+    # Любой вопрос теста
+    def __save_answer(self, update, context, record):
+        session = self.__db.active_sessions.get_by_student(record.user_id)
+        if session is None:
+            raise Exception('Cannot save answer. Student is not writing a test')
+        written_test = self.__db.tests.get_written('_id', session.written_test_id)
+        student_test = self.__db.tests.get_student(written_test.id, 'student_id', record.user_id)
+        question_id = self.__db.tests.get_question(written_test.test_id, student_test.variant_id, len(student_test.answers)).id
+        self.__db.tests.save_answer(record.user_id, written_test.id, question_id, update.message.text)
+
+        variant = self.__db.tests.get_variant(written_test.test_id, 'id', student_test.variant_id)
+        if len(student_test.answers) >= len(variant.questions):
+            self.__finish_student(written_test.id, record.user_id)
+
+    # Оцените результаты, выставьте баллы в соответствующую графу и пришлите изменённый файл в ответном сообщении
+    def __check_test(self, update, context, record):
+        if not update.message.document:
+            return
+        file = self.__download_file(update, context, WRITTEN_TESTS_FOLDERNAME)
+        finished_test = self.__db.tests.post_finished(update.message.document.file_name, file)
+
+        deliveries = []
+        with self.__dialog_data.preload(finished_test):
+            for test in finished_test.student_tests:
+                student_record = DialogRecord(test.student_id, DialogState.STUDENT_TEST_CHECKED.value,\
+                        written_test_id=finished_test.id)
+                deliveries.append((test.student_id, self.__prepare_state(student_record)))
+        self.__broadcast(context, record.user_id, deliveries)
 
     #endregion
 
@@ -182,27 +255,194 @@ class Bot:
         for message in answer.text.messages:
             context.bot.sendMessage(chat_id=user_id, text=message, reply_markup=answer.markup)
 
-    def __restart_dialog(self, update, context, user_id):
-        del self.__dialogs[user_id]
-        return self.__message_handler(update, context)
+    def __dialog_lock(self, user_id) -> threading.RLock:
+        with self.__dialog_locks_lock:
+            lock = self.__dialog_locks.get(user_id)
+            if lock is None:
+                lock = threading.RLock()
+                self.__dialog_locks[user_id] = lock
+            return lock
+
+    def __prepare_state(self, record: DialogRecord) -> DialogAnswer:
+        """Saves user's dialog state and returns the answer of the state"""
+        with self.__dialog_lock(record.user_id):
+            self.__db.dialogs.save(record)
+            self.__schedule_question(record)
+            return DIALOG_STATES[DialogState(record.state)].answer(record, self.__dialog_data)
+
+    def __enter_state(self, context, record: DialogRecord) -> None:
+        answer = self.__prepare_state(record)
+        print("\nAnswer: %r" % answer.text.messages)
+        self.__send_message(context, record.user_id, answer)
+
+        #Рестарт диалога, если конец ветки
+        if DIALOG_STATES[DialogState(record.state)].terminal:
+            self.__restart_dialog(context, record.user_id)
+
+    def __broadcast(self, context, tutor_id, deliveries):
+        report = self.__broadcaster.broadcast(deliveries)
+        print('\nBroadcast: %i/%i delivered in %.2fs, failed %r' %\
+                (report.delivered, report.total, report.duration, report.failed))
+        self.__send_message(context, tutor_id, broadcast_report(report.delivered, report.total))
+
+    def __restart_dialog(self, context, user_id):
+        user = self.__db.users.get_user(user_id)
+        if user is not None and user.is_tutor:
+            # tutor cannot leave his running test until he stops it
+            session = self.__db.active_sessions.get_by_tutor(user_id)
+            if session is not None:
+                return self.__enter_state(context, DialogRecord(user_id,\
+                        DialogState.TUTOR_TEST_RUNNING.value, written_test_id=session.written_test_id))
+            state = DialogState.TUTOR_START
+        elif user is None:
+            state = DialogState.STUDENT_SELECT_GROUP
+        else:
+            state = DialogState.STUDENT_IDLE
+        self.__enter_state(context, DialogRecord(user_id, state.value))
 
-    def __download_file(self, update, context, subpath = ''):
+    def __download_file(self, update, context, subpath = '') -> io.BytesIO:
+        """Downloads the document into memory, a copy is archived in background"""
         name = update.message.document.file_name
-        with open(f'{RUNTIME_FOLDER}/' + subpath + name, 'wb') as f:
-            context.bot.get_file(update.message.document).download(out=f)
+        file = io.BytesIO()
+        context.bot.get_file(update.message.document).download(out=file)
+        self.__db.archive.save(subpath, name, file.getvalue())
+        file.seek(0)
+        return file
+
+    def __finish_test(self, context, session: ActiveSession) -> None:
+        """
+        Finishes the test and notifies students, results are sent to the
+        tutor when the report is written
+        """
+        written_test = self.__db.tests.get_written('_id', session.written_test_id)
+
+        def send_report(report: Union[ExcelReport, None]) -> None:
+            if report is None:
+                self.__send_message(context, session.tutor_id, report_failed())
+                return
+            context.bot.sendDocument(chat_id=session.tutor_id,\
+                    document=report.content, filename=report.filename)
+
+        if not self.__db.tests.finish_in_background(written_test.id, send_report):
+            return # test is already being finished
+        self.__db.active_sessions.unregister(written_test.id)
+        self.__deadlines.cancel(('test', written_test.id))
+        for student_id in session.student_ids:
+            self.__deadlines.cancel(('question', student_id))
+        self.__send_message(context, session.tutor_id, report_preparing())
+
+        deliveries = []
+        for test in written_test.student_tests:
+            with self.__dialog_lock(test.student_id):
+                # students who have finished may be writing another test already
+                record = self.__db.dialogs.get(test.student_id)
+                if test.student_id not in session.student_ids\
+                        and (record is None or record.written_test_id != written_test.id):
+                    continue
+                student_record = DialogRecord(test.student_id, DialogState.STUDENT_TEST_ABORTED.value,\
+                        written_test_id=written_test.id)
+                deliveries.append((test.student_id, self.__prepare_state(student_record)))
+        self.__broadcast(context, session.tutor_id, deliveries)
+
+    def __finish_student(self, written_test_id, student_id) -> None:
+        self.__db.tests.finish_student(written_test_id, student_id)
+        self.__db.active_sessions.release_student(written_test_id, student_id)
+        self.__deadlines.cancel(('question', student_id))
+
+    #endregion
 
-    # def __get_group_id(self, name):
-    #     return [group.id for group in self.__db.groups.get_all() if group.name == name][0]
+    #region Deadlines
+
+    def __schedule_question(self, record: DialogRecord) -> None:
+        """Starts time limit of the question the student is answering"""
+        key = ('question', record.user_id)
+        session = self.__db.active_sessions.get_by_student(record.user_id)
+        if record.state != DialogState.STUDENT_QUESTION.value\
+                or session is None or session.question_time_limit is None:
+            return self.__deadlines.cancel(key)
+        self.__deadlines.schedule(key, time.time() + session.question_time_limit)
+
+    def __restore_deadlines(self) -> None:
+        """Schedules deadlines of tests which were running before restart"""
+        for session in self.__db.active_sessions.get_all():
+            if session.deadline is not None:
+                self.__deadlines.schedule(('test', session.written_test_id), session.deadline)
+            for student_id in session.student_ids:
+                record = self.__db.dialogs.get(student_id)
+                if record is not None:
+                    self.__schedule_question(record)
+
+    def __check_deadlines(self, context: tg_ext.CallbackContext) -> None:
+        for key in self.__deadlines.advance(time.time()):
+            if key[0] == 'test':
+                session = self.__db.active_sessions.get(key[1])
+                if session is None: continue
+                self.__user_dispatcher.submit(session.tutor_id,\
+                        self.__deadline_job(session.tutor_id, self.__expire_test, context, session))
+            else:
+                self.__user_dispatcher.submit(key[1],\
+                        self.__deadline_job(key[1], self.__expire_question, context, key[1]))
+
+    def __deadline_job(self, user_id, handler, *args):
+        def job():
+            with self.__dialog_lock(user_id):
+                handler(*args)
+        return job
+
+    def __expire_test(self, context, session: ActiveSession) -> None:
+        if self.__db.active_sessions.get(session.written_test_id) is None:
+            return # tutor has stopped the test meanwhile
+        self.__finish_test(context, session)
+
+        record = self.__db.dialogs.get(session.tutor_id)
+        if record is not None and record.state in (DialogState.TUTOR_TEST_STARTED.value,\
+                DialogState.TUTOR_TEST_RUNNING.value)\
+                and record.written_test_id == session.written_test_id:
+            record.state = DialogState.TUTOR_TEST_FINISHED.value
+            self.__enter_state(context, record)
+
+    def __expire_question(self, context, student_id: int) -> None:
+        if self.__deadlines.get(('question', student_id)) is not None:
+            return # student has answered meanwhile and got a new deadline
+        session = self.__db.active_sessions.get_by_student(student_id)
+        record = self.__db.dialogs.get(student_id)
+        if session is None or record is None\
+                or record.state != DialogState.STUDENT_QUESTION.value:
+            return
+        self.__finish_student(session.written_test_id, student_id)
+        self.__enter_state(context, DialogRecord(student_id, DialogState.STUDENT_TEST_ABORTED.value,\
+                written_test_id=session.written_test_id))
 
-    # def __get_test_id(self, name):
-    #     return [test.id for test in self.__db.tests.get_all() if test.name == name][0]
     #endregion
 
     #region State
 
     def idle(self) -> None:
+        """Runs the bot with long polling until it is stopped by a signal"""
         self.__updater.start_polling()
         print('Bot has started')
         self.__updater.idle()
+        self.__shutdown()
+
+    def idle_webhook(self, listen: str, port: int, webhook_url: str) -> None:
+        """
+        Runs the bot with a webhook until it is stopped by a signal.
+
+        Telegram sends updates to webhook_url, which has to be proxied to
+        listen:port with the same path.
+        """
+        url_path = urlparse(webhook_url).path
+        self.__updater.start_webhook(listen=listen, port=port,\
+                url_path=url_path, webhook_url=webhook_url)
+        print(f'Bot has started, listening on {listen}:{port}{url_path}')
+        self.__updater.idle()
+        self.__shutdown()
+
+    def __shutdown(self) -> None:
+        # updater has already stopped receiving updates, finish queued ones
+        self.__user_dispatcher.shutdown()
+        self.__broadcaster.shutdown()
+        self.__db.shutdown()
+        self.__request.stop()
 
     #endregion
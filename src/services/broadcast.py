@@ -0,0 +1,108 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import telegram as tg
+import telegram.error as tg_error
+
+from config import BROADCAST_BACKOFF, BROADCAST_CHAT_BURST,\
+        BROADCAST_CHAT_RATE, BROADCAST_GLOBAL_RATE, BROADCAST_MAX_RETRIES,\
+        BROADCAST_WORKERS
+
+from .dialogs import DialogAnswer
+
+
+class TokenBucket():
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.__capacity,\
+                        self.__tokens + (now - self.__updated_at) * self.__rate)
+                self.__updated_at = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.__rate
+            time.sleep(wait)
+
+
+@dataclass
+class BroadcastReport:
+    total: int
+    delivered: int
+    failed: list[int] # chat ids
+    duration: float # seconds
+
+
+class Broadcaster():
+    """Sends messages to many chats in parallel within Telegram rate limits"""
+
+    def __init__(self, bot: tg.Bot, workers: int = BROADCAST_WORKERS) -> None:
+        self.__bot = bot
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix='broadcast')
+        self.__global_bucket = TokenBucket(BROADCAST_GLOBAL_RATE, BROADCAST_GLOBAL_RATE)
+        self.__chat_buckets: dict[int, TokenBucket] = dict()
+        self.__chat_buckets_lock = threading.Lock()
+
+    def broadcast(self, deliveries: list[tuple[int, DialogAnswer]]) -> BroadcastReport:
+        """
+        Sends every answer to its chat and waits for all of them.
+
+        Messages of a single answer are delivered in order.
+        """
+        started_at = time.monotonic()
+        futures = [(chat_id, self.__executor.submit(self.__deliver, chat_id, answer))\
+                for chat_id, answer in deliveries]
+
+        failed = [chat_id for chat_id, future in futures if not future.result()]
+        duration = time.monotonic() - started_at
+        return BroadcastReport(len(deliveries), len(deliveries) - len(failed), failed, duration)
+
+    def shutdown(self) -> None:
+        self.__executor.shutdown(wait=True)
+
+    def __deliver(self, chat_id: int, answer: DialogAnswer) -> bool:
+        for message in answer.text.messages:
+            if not self.__send(chat_id, message, answer.markup):
+                return False
+        return True
+
+    def __send(self, chat_id: int, text: str, markup) -> bool:
+        chat_bucket = self.__get_chat_bucket(chat_id)
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            chat_bucket.acquire()
+            self.__global_bucket.acquire()
+            try:
+                self.__bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+                return True
+            except tg_error.RetryAfter as e:
+                time.sleep(e.retry_after)
+            except (tg_error.BadRequest, tg_error.Unauthorized) as e:
+                print(f'\nCannot send message to {chat_id}:', e)
+                return False
+            except tg_error.NetworkError as e:
+                print(f'\nNetwork error while sending to {chat_id}:', e)
+                time.sleep(BROADCAST_BACKOFF * 2 ** attempt)
+            except tg_error.TelegramError as e:
+                print(f'\nCannot send message to {chat_id}:', e)
+                return False
+        return False
+
+    def __get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self.__chat_buckets_lock:
+            bucket = self.__chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(BROADCAST_CHAT_RATE, BROADCAST_CHAT_BURST)
+                self.__chat_buckets[chat_id] = bucket
+            return bucket
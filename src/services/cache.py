@@ -0,0 +1,59 @@
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, TypeVar
+
+from cachetools import TTLCache
+
+from config import IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL
+
+
+T = TypeVar('T')
+
+@dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    size: int
+
+
+class IdentityCache():
+    """
+    Size-bounded TTL cache of table entities.
+
+    Missing entities (None) are cached as well, so the table has to clear
+    the cache on every write.
+    """
+
+    def __init__(self,
+            maxsize: int = IDENTITY_CACHE_SIZE,
+            ttl: float = IDENTITY_CACHE_TTL) -> None:
+        self.__cache: TTLCache = TTLCache(maxsize, ttl)
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__generation = 0 # increased on clear to drop values loaded before
+
+    def get(self, key: Hashable, load: Callable[[], T]) -> T:
+        """Returns cached value or loads and caches it"""
+        with self.__lock:
+            found: Any = self.__cache.get(key, self)
+            if found is not self:
+                self.__hits += 1
+                return found
+            self.__misses += 1
+            generation = self.__generation
+
+        value = load()
+        with self.__lock:
+            if generation == self.__generation:
+                self.__cache[key] = value
+        return value
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__cache.clear()
+            self.__generation += 1
+
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(self.__hits, self.__misses, len(self.__cache))
@@ -3,25 +3,38 @@ import pathlib
 import shutil
 from pymongo import MongoClient, database
 
-from config import GROUP_COLLECTION_NAME, RUNTIME_FOLDER, \
-        TEST_COLLECTION_NAME, TESTS_FOLDERNAME, USER_COLLECTION_NAME, \
-        WRITTEN_TEST_COLLECTION_NAME, WRITTEN_TESTS_FOLDERNAME
-
+from config import ACTIVE_SESSION_COLLECTION_NAME, DATABASE_INDEXES, DIALOG_STATE_COLLECTION_NAME,\
+        GROUP_COLLECTION_NAME, RUNTIME_FOLDER, STUDENT_TEST_COLLECTION_NAME, TEST_COLLECTION_NAME, TESTS_FOLDERNAME, USER_COLLECTION_NAME, \
+        WRITTEN_TEST_COLLECTION_NAME, WRITTEN_TEST_STORAGE, WRITTEN_TESTS_FOLDERNAME
+
+from .active_sessions import ActiveSessionsTable
+from .archive import FileArchive
+from .cache import CacheStats
+from .diagnostics import QueryPlan, explain_queries
 from .tests import TestsTable
 from .users import UsersTable
 from .groups import GroupsTable
+from .states import DialogStatesTable
+from .written_storage import create_written_storage, migrate_to_student_tests
 
 
 class DataBase():
 
     def __init__(self,
-            db_url: str) -> None:
+            db_url: str,
+            written_storage: str = WRITTEN_TEST_STORAGE) -> None:
         self.__db_client = MongoClient(db_url)
         db = self.create_database()
+        self.__db = db
 
+        self.archive = FileArchive()
         self.groups = GroupsTable(db)
-        self.tests = TestsTable(db)
         self.users = UsersTable(db)
+        self.tests = TestsTable(db, self.users, self.groups,\
+                written_storage=create_written_storage(written_storage, db),\
+                archive=self.archive)
+        self.dialogs = DialogStatesTable(db)
+        self.active_sessions = ActiveSessionsTable(db)
 
         self.create_runtime_folders()
 
@@ -59,16 +72,48 @@ class DataBase():
         self.__create_db_collection(db, GROUP_COLLECTION_NAME)
         self.__create_db_collection(db, TEST_COLLECTION_NAME)
         self.__create_db_collection(db, WRITTEN_TEST_COLLECTION_NAME)
+        self.__create_db_collection(db, STUDENT_TEST_COLLECTION_NAME)
         self.__create_db_collection(db, USER_COLLECTION_NAME)
+        self.__create_db_collection(db, DIALOG_STATE_COLLECTION_NAME)
+        self.__create_db_collection(db, ACTIVE_SESSION_COLLECTION_NAME)
+        self.create_indexes(db)
         return db
 
     def __create_db_collection(self, db: database.Database, name: str) -> None:
-        collection = db.get_collection(name)
-        insertion = collection.insert_one({})
-        collection.delete_one({ '_id': insertion.inserted_id })
+        if name not in db.list_collection_names():
+            db.create_collection(name)
+
+    def create_indexes(self, db: database.Database) -> None:
+        """Creates indexes from DATABASE_INDEXES, existing ones are kept"""
+        for name, indexes in DATABASE_INDEXES.items():
+            collection = db.get_collection(name)
+            for keys, options in indexes:
+                collection.create_index(keys, **options)
+
+    def shutdown(self) -> None:
+        self.tests.shutdown()
+        self.archive.shutdown()
+        self.__db_client.close()
+
+    def cache_stats(self) -> dict[str, CacheStats]:
+        return { 'users': self.users.cache_stats(), 'groups': self.groups.cache_stats() }
+
+    def explain_queries(self) -> list[QueryPlan]:
+        return explain_queries(self.__db)
+
+    def migrate_to_student_tests(self) -> int:
+        """Moves student tests out of written test documents"""
+        return migrate_to_student_tests(self.__db)
 
     def clear_database(self) -> None:
         self.__db_client.drop_database(os.environ['MONGODB_DATABASE'])
         self.create_database()
+        # drop in-memory state of removed documents
+        self.users.remove_users()
+        self.groups.remove_all()
+        self.dialogs.remove_all()
+        self.active_sessions.remove_all()
+        self.tests.remove_all()
+        self.tests.remove_written()
 
     #endregion
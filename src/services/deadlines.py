@@ -0,0 +1,71 @@
+import math
+import threading
+from typing import Hashable, Union
+
+from config import DEADLINE_TICK, DEADLINE_WHEEL_SLOTS
+
+
+class TimerWheel():
+    """
+    Hashed timing wheel of deadlines.
+
+    Deadlines are put into slots by their tick, advancing the wheel only
+    looks at the slots of elapsed ticks. Scheduling, rescheduling and
+    cancelling are O(1), so thousands of pending deadlines cost neither
+    threads nor scheduler jobs. Deadlines fire up to one tick late.
+    """
+
+    def __init__(self,
+            now: float,
+            tick: float = DEADLINE_TICK,
+            slots: int = DEADLINE_WHEEL_SLOTS) -> None:
+        self.__tick = tick
+        self.__slots: list[set[Hashable]] = [set() for _ in range(slots)]
+        self.__deadlines: dict[Hashable, tuple[float, int]] = dict() # key -> deadline, slot
+        self.__current = self.__to_tick(now)
+        self.__lock = threading.Lock()
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Sets deadline of the key, replaces the previous one"""
+        with self.__lock:
+            self.__remove(key)
+            # overdue deadlines go to the next slot to be checked
+            slot = max(self.__to_tick(deadline), self.__current) % len(self.__slots)
+            self.__deadlines[key] = (deadline, slot)
+            self.__slots[slot].add(key)
+
+    def cancel(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__remove(key)
+
+    def get(self, key: Hashable) -> Union[float, None]:
+        found = self.__deadlines.get(key)
+        return found[0] if found is not None else None
+
+    def advance(self, now: float) -> list[Hashable]:
+        """Moves the wheel to now and returns keys of expired deadlines"""
+        expired: list[Hashable] = []
+        with self.__lock:
+            target = self.__to_tick(now)
+            # a full turn checks every slot, later ticks have nothing new
+            last = min(target, self.__current + len(self.__slots) - 1)
+            for tick in range(self.__current, last + 1):
+                slot = self.__slots[tick % len(self.__slots)]
+                # deadlines of later turns stay in the slot
+                due = [key for key in slot if self.__deadlines[key][0] <= now]
+                for key in due:
+                    self.__remove(key)
+                expired += due
+            self.__current = max(self.__current, target)
+        return expired
+
+    def __remove(self, key: Hashable) -> None:
+        found = self.__deadlines.pop(key, None)
+        if found is None: return
+        self.__slots[found[1]].discard(key)
+
+    def __to_tick(self, time: float) -> int:
+        return math.floor(time / self.__tick)
+
+    def __len__(self) -> int:
+        return len(self.__deadlines)
@@ -0,0 +1,120 @@
+import pathlib
+import subprocess
+import sys
+from dataclasses import dataclass
+
+from bson import ObjectId
+from pymongo import database
+
+from config import STARTUP_IMPORT_BUDGET, STARTUP_LAZY_MODULES,\
+        ACTIVE_SESSION_COLLECTION_NAME, DIALOG_STATE_COLLECTION_NAME, GROUP_COLLECTION_NAME,\
+        STUDENT_TEST_COLLECTION_NAME, TEST_COLLECTION_NAME,\
+        USER_COLLECTION_NAME, WRITTEN_TEST_COLLECTION_NAME
+
+
+# Queries issued by the tables as (collection, filter) with sample values
+QUERIES: list[tuple[str, dict]] = [
+        # UsersTable
+        (USER_COLLECTION_NAME, { 'is_tutor': True }),
+        (USER_COLLECTION_NAME, { 'telegram_id': 0 }),
+        (USER_COLLECTION_NAME, { 'role': 'tutor' }),
+        (USER_COLLECTION_NAME, { 'is_tutor': False, 'group_id': ObjectId() }),
+        (USER_COLLECTION_NAME, { 'name': '' }),
+        (USER_COLLECTION_NAME, { 'is_tutor': False, 'name': { '$in': [''] } }),
+        # GroupsTable
+        (GROUP_COLLECTION_NAME, { '_id': ObjectId() }),
+        (GROUP_COLLECTION_NAME, { 'name': '' }),
+        # TestsTable
+        (TEST_COLLECTION_NAME, { '_id': ObjectId() }),
+        (TEST_COLLECTION_NAME, { 'name': '' }),
+        (TEST_COLLECTION_NAME, { 'content_hash': '', 'name': '' }),
+        (WRITTEN_TEST_COLLECTION_NAME, { '_id': ObjectId() }),
+        (WRITTEN_TEST_COLLECTION_NAME, { 'finish_time': '' }),
+        # StudentTestsWrittenStorage
+        (STUDENT_TEST_COLLECTION_NAME, { 'written_test_id': ObjectId() }),
+        (STUDENT_TEST_COLLECTION_NAME, { 'written_test_id': ObjectId(), 'student_id': 0 }),
+        (STUDENT_TEST_COLLECTION_NAME, { 'written_test_id': ObjectId(), 'finish_time': None }),
+        # DialogStatesTable
+        (DIALOG_STATE_COLLECTION_NAME, { 'user_id': 0 }),
+        # ActiveSessionsTable
+        (ACTIVE_SESSION_COLLECTION_NAME, { 'written_test_id': ObjectId() }),
+        ]
+
+
+@dataclass
+class QueryPlan:
+    collection: str
+    filter: dict
+    stages: list[str]
+    is_collection_scan: bool
+
+
+def explain_queries(db: database.Database) -> list[QueryPlan]:
+    """Explains every query of QUERIES and flags collection scans"""
+    plans: list[QueryPlan] = []
+    for name, filter in QUERIES:
+        explanation = db[name].find(filter).explain()
+        winning_plan = explanation['queryPlanner']['winningPlan']
+        stages = get_plan_stages(winning_plan)
+        plans.append(QueryPlan(name, filter, stages, 'COLLSCAN' in stages))
+    return plans
+
+
+def print_query_plans(plans: list[QueryPlan]) -> None:
+    for plan in plans:
+        mark = 'COLLECTION SCAN' if plan.is_collection_scan else 'ok'
+        print(f'[{mark}] {plan.collection} {plan.filter}: {" <- ".join(plan.stages)}')
+
+
+def get_plan_stages(plan: dict) -> list[str]:
+    """Returns plan stages from the root to the leaves"""
+    stages = [plan['stage']] if 'stage' in plan else []
+    # newer servers wrap the plan into queryPlan
+    children = [plan[key] for key in ['queryPlan', 'inputStage'] if key in plan]
+    children += plan.get('inputStages', [])
+    for child in children:
+        stages += get_plan_stages(child)
+    return stages
+
+
+@dataclass
+class StartupProfile:
+    total: float # seconds to import the module with its dependencies
+    packages: dict[str, float] # top level package -> seconds of its own modules
+    lazy_modules: list[str] # modules of STARTUP_LAZY_MODULES which were imported
+    is_over_budget: bool
+
+
+def profile_startup(module: str = 'src.services.bot') -> StartupProfile:
+    """Imports the module in a new interpreter and measures time per module"""
+    root = pathlib.Path(__file__).resolve().parents[2]
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],\
+            cwd=root, capture_output=True, text=True, check=True)
+
+    total = 0.0
+    packages: dict[str, float] = dict()
+    lazy_modules: list[str] = []
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix('import time:').split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit(): continue
+        self_time = int(fields[0]) / 1e6
+        name = fields[2].strip()
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_time
+        if name == module:
+            total = int(fields[1]) / 1e6
+        if name in STARTUP_LAZY_MODULES:
+            lazy_modules.append(name)
+
+    is_over_budget = total > STARTUP_IMPORT_BUDGET or len(lazy_modules) > 0
+    return StartupProfile(total, packages, lazy_modules, is_over_budget)
+
+
+def print_startup_profile(profile: StartupProfile, top: int = 20) -> None:
+    packages = sorted(profile.packages.items(), key=lambda p: p[1], reverse=True)
+    for package, seconds in packages[:top]:
+        print(f'{seconds * 1000:8.1f}ms  {package}')
+    print(f'total {profile.total * 1000:.1f}ms, budget {STARTUP_IMPORT_BUDGET * 1000:.0f}ms')
+    if len(profile.lazy_modules) > 0:
+        print(f'imported at startup, have to be imported on first use: {", ".join(profile.lazy_modules)}')
@@ -0,0 +1,91 @@
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+from ..models.dialog import DialogRecord
+from ..models.test import StudentWrittenTest, TestQuestion, WrittenTest
+
+from .db import DataBase
+
+
+@dataclass
+class PreloadedWrittenTest:
+    written_test: WrittenTest
+    test_name: str
+    students: dict[int, StudentWrittenTest] # student id -> student test
+
+
+class DataBaseDialogData():
+    """Provides dialogs with data from the database"""
+
+    def __init__(self, db: DataBase) -> None:
+        self.__db = db
+        self.__preloaded: dict[Any, PreloadedWrittenTest] = dict()
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def preload(self, written_test: WrittenTest) -> Iterator[None]:
+        """
+        Answers built inside the block take the written test from memory,
+        e.g. while results are being sent to every student of the test
+        """
+        students = dict([(student_test.student_id, student_test)\
+                for student_test in written_test.student_tests])
+        preloaded = PreloadedWrittenTest(written_test, self.__get_name(written_test), students)
+        with self.__lock:
+            self.__preloaded[written_test.id] = preloaded
+        try:
+            yield
+        finally:
+            with self.__lock:
+                if self.__preloaded.get(written_test.id) is preloaded:
+                    self.__preloaded.pop(written_test.id)
+
+    def test_names(self) -> list[str]:
+        return self.__db.tests.list_names()
+
+    def group_names(self) -> list[str]:
+        return [group.name for group in self.__db.groups.get_all()]
+
+    def test_name(self, record: DialogRecord) -> str:
+        preloaded = self.__preloaded.get(record.written_test_id)
+        if preloaded is not None: return preloaded.test_name
+        return self.__get_name(self.__get_written(record))
+
+    def questions(self, record: DialogRecord) -> list[TestQuestion]:
+        written_test = self.__get_written(record)
+        student_test = self.__db.tests.get_student(record.written_test_id, 'student_id', record.user_id)
+        if student_test is None:
+            raise Exception('Student test was not found')
+        variant = self.__db.tests.get_variant(written_test.test_id, 'id', student_test.variant_id)
+        if variant is None:
+            raise Exception('Variant was not found')
+        return variant.questions
+
+    def result(self, record: DialogRecord) -> tuple[float, float]:
+        preloaded = self.__preloaded.get(record.written_test_id)
+        if preloaded is not None:
+            written_test = preloaded.written_test
+            student_test = preloaded.students.get(record.user_id)
+        else:
+            written_test = self.__get_written(record)
+            student_test = self.__db.tests.get_student(None, 'student_id', record.user_id, written_test)
+        if student_test is None:
+            raise Exception('Student test was not found')
+        variant = self.__db.tests.get_variant(written_test.test_id, 'id', student_test.variant_id)
+        if variant is None:
+            raise Exception('Variant was not found')
+        return student_test.sum_mark or 0, variant.sum_max_mark
+
+    def __get_written(self, record: DialogRecord) -> WrittenTest:
+        written_test = self.__db.tests.get_written('_id', record.written_test_id)
+        if written_test is None:
+            raise Exception('Written test was not found')
+        return written_test
+
+    def __get_name(self, written_test: WrittenTest) -> str:
+        name = self.__db.tests.get_name(written_test.test_id)
+        if name is None:
+            raise Exception('Test was not found')
+        return name
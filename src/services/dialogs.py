@@ -1,10 +1,11 @@
+from dataclasses import dataclass
 from enum import Enum
-from typing import List, Union
+from typing import Callable, List, Protocol, Union
 import uuid
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove
 
-from ..models.group import Group
-from ..models.test import Test, TestQuestion
+from ..models.dialog import DialogRecord
+from ..models.test import TestQuestion
 
 TEST_QUESTION_ID = uuid.uuid4()
 
@@ -79,66 +80,226 @@ class StudentTestBranch(Enum):
 def create_keyboard(buttons: list[list[str]]):
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True, one_time_keyboard=True)
 
-def ask_file(question): #deprecated - Пока не придумал, как использовать для множественных файлов
-    answer = yield question
-    while not ('.xlsx' in answer.document.file_name):
-        answer = yield DialogAnswer(TutorSettingsBranch.FILE_FORMAT_ERROR.value)
-    return True
-
-def tutorStartDialog(tests: List[Test], groups: List[Group]):
-    answer = yield DialogAnswer(TutorStartDialog.HELLO.value, create_keyboard([[option.value for option in TutorDialogOptions]]))
-    if answer.text == TutorDialogOptions.SETTINGS.value:
-        yield from tutor_settings_branch()
-    elif answer.text == TutorDialogOptions.TEST.value:
-        yield from tutor_test_branch(tests, groups)
-    else:
-        yield from tutor_check_branch()
-
-def tutor_settings_branch():
-    answer = yield DialogAnswer(TutorSettingsBranch.CHOOSE_OPTION.value, create_keyboard([[option.value for option in TutorSettingsBranchOptions]]))
-    if answer.text == TutorSettingsBranchOptions.GROUPS.value:
-        yield DialogAnswer(TutorSettingsBranch.ENTER_GROUPS.value)
-        yield DialogAnswer(TutorSettingsBranch.SUCCESS.value)
-    elif answer.text == TutorSettingsBranchOptions.TESTS.value:
-        answer = yield DialogAnswer(TutorSettingsBranch.ENTER_TESTS.value, create_keyboard([[option.value for option in TutorSettingsEnterTestsOptions]]))
-        while not(answer.text == TutorSettingsEnterTestsOptions.FINISH.value):
-            answer = yield DialogAnswer([])
-        yield DialogAnswer(TutorSettingsBranch.SUCCESS.value)
-    elif answer.text == TutorSettingsBranchOptions.DATABASE.value:
-        answer = yield DialogAnswer(TutorSettingsBranch.CLEAR_DATABASE.value, create_keyboard([[option.value for option in TutorSettingsClearDatabaseOptions]]))
-        if answer.text == TutorSettingsClearDatabaseOptions.CONFIRM.value:
-            yield DialogAnswer(TutorSettingsBranch.CLEAR_DATABASE_SUCCESS.value)
-        if answer.text == TutorSettingsClearDatabaseOptions.DECLINE.value:
-            yield DialogAnswer(TutorSettingsBranch.CLEAR_DATABASE_DECLINE.value)
-
-def tutor_test_branch(tests: List[Test], groups: List[Group]):
-    yield DialogAnswer(TutorTestBranch.SELECT_TEST.value, create_keyboard([[test.name for test in tests]]))
-    yield DialogAnswer(TutorTestBranch.SELECT_GROUP.value, create_keyboard([[group.name for group in groups]]))
-    answer = yield DialogAnswer(TutorTestBranch.SUCCESS.value, create_keyboard([[option.value for option in TutorTestSuccessOptions]]))
-    if (answer.text == TutorTestSuccessOptions.STOP.value):
-        yield DialogAnswer(TutorTestBranch.FINISH.value)
-
-def tutor_check_branch():
-    yield DialogAnswer(TutorCheckBranch.SEND_FILE.value)
-    yield DialogAnswer(TutorCheckBranch.SUCCESS.value)
-
-def student_settings_branch(groups: List[Group]):
-    yield DialogAnswer(StudentSettingsBranch.SELECT_GROUP.value, create_keyboard([[group.name for group in groups]]))
-    yield DialogAnswer(StudentSettingsBranch.ENTER_FIO.value)
-    yield DialogAnswer(StudentSettingsBranch.SUCCESS.value)
-
-def student_exists_branch():
-    yield DialogAnswer(StudentExistsBranch.NO_TEST.value)
-
-
-def student_test_branch(test_name: str, questions: List[TestQuestion]):
-    yield DialogAnswer(DialogAnswerText(["ВНИМАНИЕ! Начинаем летучку %s" % test_name, "Вопрос %i: %s" % (1, questions[0].text)], TEST_QUESTION_ID))
-    for index, question in enumerate(questions[1:]):
-        yield DialogAnswer(DialogAnswerText("Вопрос %i: %s" % (index+2, question.text), TEST_QUESTION_ID))
-    yield DialogAnswer(StudentTestBranch.FINISH.value)
-
-def student_abort_test():
-    yield DialogAnswer(StudentTestBranch.ABORT.value)
-
-def student_check_branch(test_name: str, mark: int, max_mark: int):
-    yield DialogAnswer(DialogAnswerText(["Привет!",f'Твоя летучка “{test_name}” оценена\n\nБаллы: {round(mark, 2)}/{max_mark}']))
+
+# region State table
+
+class DialogState(Enum):
+    TUTOR_START = 'tutor_start'
+    TUTOR_SETTINGS = 'tutor_settings'
+    TUTOR_ENTER_GROUPS = 'tutor_enter_groups'
+    TUTOR_ENTER_TESTS = 'tutor_enter_tests'
+    TUTOR_MORE_TESTS = 'tutor_more_tests'
+    TUTOR_SETTINGS_SUCCESS = 'tutor_settings_success'
+    TUTOR_CLEAR_DATABASE = 'tutor_clear_database'
+    TUTOR_CLEAR_DATABASE_SUCCESS = 'tutor_clear_database_success'
+    TUTOR_CLEAR_DATABASE_DECLINE = 'tutor_clear_database_decline'
+    TUTOR_SELECT_TEST = 'tutor_select_test'
+    TUTOR_SELECT_GROUP = 'tutor_select_group'
+    TUTOR_TEST_STARTED = 'tutor_test_started'
+    TUTOR_TEST_RUNNING = 'tutor_test_running'
+    TUTOR_TEST_FINISHED = 'tutor_test_finished'
+    TUTOR_SEND_FILE = 'tutor_send_file'
+    TUTOR_CHECK_SUCCESS = 'tutor_check_success'
+    STUDENT_SELECT_GROUP = 'student_select_group'
+    STUDENT_ENTER_FIO = 'student_enter_fio'
+    STUDENT_REGISTERED = 'student_registered'
+    STUDENT_IDLE = 'student_idle'
+    STUDENT_QUESTION = 'student_question'
+    STUDENT_TEST_FINISHED = 'student_test_finished'
+    STUDENT_TEST_ABORTED = 'student_test_aborted'
+    STUDENT_TEST_CHECKED = 'student_test_checked'
+
+class DialogData(Protocol):
+    """Data from the database needed to build dialog answers"""
+
+    def test_names(self) -> list[str]: ...
+
+    def group_names(self) -> list[str]: ...
+
+    def test_name(self, record: DialogRecord) -> str: ...
+
+    def questions(self, record: DialogRecord) -> list[TestQuestion]: ...
+
+    def result(self, record: DialogRecord) -> tuple[float, float]:
+        """Returns student's mark and max mark"""
+        ...
+
+AnswerBuilder = Callable[[DialogRecord, DialogData], DialogAnswer]
+Transition = Callable[[DialogRecord, Message, DialogData], Union[DialogState, None]]
+
+@dataclass
+class DialogStep:
+    answer: AnswerBuilder # sent when the user enters the state
+    next: Transition # returns None when the dialog has to be restarted
+    terminal: bool = False # dialog is restarted right after the answer
+
+def static_answer(text: DialogAnswerText, options: Union[type[Enum], None] = None) -> AnswerBuilder:
+    if options is None:
+        return lambda record, data: DialogAnswer(text)
+    markup = create_keyboard([[option.value for option in options]])
+    return lambda record, data: DialogAnswer(text, markup)
+
+def goto(state: Union[DialogState, None]) -> Transition:
+    return lambda record, message, data: state
+
+def choose(states: dict[str, DialogState]) -> Transition:
+    return lambda record, message, data: states.get(message.text)
+
+def select_test_answer(record: DialogRecord, data: DialogData) -> DialogAnswer:
+    return DialogAnswer(TutorTestBranch.SELECT_TEST.value, create_keyboard([data.test_names()]))
+
+def select_group_answer(text: DialogAnswerText) -> AnswerBuilder:
+    return lambda record, data: DialogAnswer(text, create_keyboard([data.group_names()]))
+
+def enter_tests_next(record: DialogRecord, message: Message, data: DialogData) -> DialogState:
+    if message.text == TutorSettingsEnterTestsOptions.FINISH.value:
+        return DialogState.TUTOR_SETTINGS_SUCCESS
+    return DialogState.TUTOR_MORE_TESTS
+
+def select_group_next(record: DialogRecord, message: Message, data: DialogData) -> Union[DialogState, None]:
+    # test is not started when every student of the group is busy
+    if record.written_test_id is None:
+        return None
+    return DialogState.TUTOR_TEST_STARTED
+
+def running_test_answer(record: DialogRecord, data: DialogData) -> DialogAnswer:
+    markup = create_keyboard([[option.value for option in TutorTestSuccessOptions]])
+    return DialogAnswer(DialogAnswerText([f'Идёт летучка “{data.test_name(record)}”',\
+            "Остановите её, чтобы продолжить работу с ботом"]), markup)
+
+def question_answer(record: DialogRecord, data: DialogData) -> DialogAnswer:
+    index = record.question_index
+    question = data.questions(record)[index]
+    messages = ["Вопрос %i: %s" % (index + 1, question.text)]
+    if index == 0:
+        messages.insert(0, "ВНИМАНИЕ! Начинаем летучку %s" % data.test_name(record))
+    return DialogAnswer(DialogAnswerText(messages, TEST_QUESTION_ID))
+
+def question_next(record: DialogRecord, message: Message, data: DialogData) -> DialogState:
+    record.question_index += 1
+    if record.question_index < len(data.questions(record)):
+        return DialogState.STUDENT_QUESTION
+    return DialogState.STUDENT_TEST_FINISHED
+
+def check_answer(record: DialogRecord, data: DialogData) -> DialogAnswer:
+    mark, max_mark = data.result(record)
+    return DialogAnswer(DialogAnswerText(["Привет!",f'Твоя летучка “{data.test_name(record)}” оценена\n\nБаллы: {round(mark, 2)}/{max_mark}']))
+
+DIALOG_STATES: dict[DialogState, DialogStep] = {
+    DialogState.TUTOR_START: DialogStep(
+        static_answer(TutorStartDialog.HELLO.value, TutorDialogOptions),
+        lambda record, message, data: {
+            TutorDialogOptions.SETTINGS.value: DialogState.TUTOR_SETTINGS,
+            TutorDialogOptions.TEST.value: DialogState.TUTOR_SELECT_TEST,
+            }.get(message.text, DialogState.TUTOR_SEND_FILE)),
+
+    # Settings
+    DialogState.TUTOR_SETTINGS: DialogStep(
+        static_answer(TutorSettingsBranch.CHOOSE_OPTION.value, TutorSettingsBranchOptions),
+        choose({
+            TutorSettingsBranchOptions.GROUPS.value: DialogState.TUTOR_ENTER_GROUPS,
+            TutorSettingsBranchOptions.TESTS.value: DialogState.TUTOR_ENTER_TESTS,
+            TutorSettingsBranchOptions.DATABASE.value: DialogState.TUTOR_CLEAR_DATABASE,
+            })),
+    DialogState.TUTOR_ENTER_GROUPS: DialogStep(
+        static_answer(TutorSettingsBranch.ENTER_GROUPS.value),
+        goto(DialogState.TUTOR_SETTINGS_SUCCESS)),
+    DialogState.TUTOR_ENTER_TESTS: DialogStep(
+        static_answer(TutorSettingsBranch.ENTER_TESTS.value, TutorSettingsEnterTestsOptions),
+        enter_tests_next),
+    DialogState.TUTOR_MORE_TESTS: DialogStep(
+        static_answer(DialogAnswerText([])),
+        enter_tests_next),
+    DialogState.TUTOR_SETTINGS_SUCCESS: DialogStep(
+        static_answer(TutorSettingsBranch.SUCCESS.value),
+        goto(None),
+        terminal=True),
+    DialogState.TUTOR_CLEAR_DATABASE: DialogStep(
+        static_answer(TutorSettingsBranch.CLEAR_DATABASE.value, TutorSettingsClearDatabaseOptions),
+        choose({
+            TutorSettingsClearDatabaseOptions.CONFIRM.value: DialogState.TUTOR_CLEAR_DATABASE_SUCCESS,
+            TutorSettingsClearDatabaseOptions.DECLINE.value: DialogState.TUTOR_CLEAR_DATABASE_DECLINE,
+            })),
+    DialogState.TUTOR_CLEAR_DATABASE_SUCCESS: DialogStep(
+        static_answer(TutorSettingsBranch.CLEAR_DATABASE_SUCCESS.value),
+        goto(None),
+        terminal=True),
+    DialogState.TUTOR_CLEAR_DATABASE_DECLINE: DialogStep(
+        static_answer(TutorSettingsBranch.CLEAR_DATABASE_DECLINE.value),
+        goto(None),
+        terminal=True),
+
+    # Test
+    DialogState.TUTOR_SELECT_TEST: DialogStep(
+        select_test_answer,
+        goto(DialogState.TUTOR_SELECT_GROUP)),
+    DialogState.TUTOR_SELECT_GROUP: DialogStep(
+        select_group_answer(TutorTestBranch.SELECT_GROUP.value),
+        select_group_next),
+    DialogState.TUTOR_TEST_STARTED: DialogStep(
+        static_answer(TutorTestBranch.SUCCESS.value, TutorTestSuccessOptions),
+        choose({ TutorTestSuccessOptions.STOP.value: DialogState.TUTOR_TEST_FINISHED })),
+    # tutor has left a running test, he is returned to it on restart
+    DialogState.TUTOR_TEST_RUNNING: DialogStep(
+        running_test_answer,
+        choose({ TutorTestSuccessOptions.STOP.value: DialogState.TUTOR_TEST_FINISHED })),
+    DialogState.TUTOR_TEST_FINISHED: DialogStep(
+        static_answer(TutorTestBranch.FINISH.value),
+        goto(None),
+        terminal=True),
+
+    # Check
+    DialogState.TUTOR_SEND_FILE: DialogStep(
+        static_answer(TutorCheckBranch.SEND_FILE.value),
+        goto(DialogState.TUTOR_CHECK_SUCCESS)),
+    DialogState.TUTOR_CHECK_SUCCESS: DialogStep(
+        static_answer(TutorCheckBranch.SUCCESS.value),
+        goto(None),
+        terminal=True),
+
+    # Student settings
+    DialogState.STUDENT_SELECT_GROUP: DialogStep(
+        select_group_answer(StudentSettingsBranch.SELECT_GROUP.value),
+        goto(DialogState.STUDENT_ENTER_FIO)),
+    DialogState.STUDENT_ENTER_FIO: DialogStep(
+        static_answer(StudentSettingsBranch.ENTER_FIO.value),
+        goto(DialogState.STUDENT_REGISTERED)),
+    DialogState.STUDENT_REGISTERED: DialogStep(
+        static_answer(StudentSettingsBranch.SUCCESS.value),
+        goto(None)),
+    DialogState.STUDENT_IDLE: DialogStep(
+        static_answer(StudentExistsBranch.NO_TEST.value),
+        goto(None)),
+
+    # Student test
+    DialogState.STUDENT_QUESTION: DialogStep(
+        question_answer,
+        question_next),
+    DialogState.STUDENT_TEST_FINISHED: DialogStep(
+        static_answer(StudentTestBranch.FINISH.value),
+        goto(None)),
+    DialogState.STUDENT_TEST_ABORTED: DialogStep(
+        static_answer(StudentTestBranch.ABORT.value),
+        goto(None)),
+    DialogState.STUDENT_TEST_CHECKED: DialogStep(
+        check_answer,
+        goto(None)),
+    }
+
+# endregion
+
+
+def broadcast_report(delivered: int, total: int):
+    return DialogAnswer(DialogAnswerText(f'Сообщение получили {delivered} из {total} студентов'))
+
+def report_preparing():
+    return DialogAnswer(DialogAnswerText('Готовлю отчёт по летучке, файл придёт следующим сообщением'))
+
+def report_failed():
+    return DialogAnswer(DialogAnswerText('Не удалось подготовить отчёт по летучке'))
+
+def test_no_students():
+    return DialogAnswer(DialogAnswerText('Летучка не началась: в группе нет студентов, которые могут её писать'))
+
+def test_skipped_students(names: list[str]):
+    return DialogAnswer(DialogAnswerText('Эти студенты пишут другую летучку и не участвуют в этой:\n' + '\n'.join(names)))
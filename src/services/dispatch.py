@@ -0,0 +1,60 @@
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union
+
+from config import DISPATCH_WORKERS, UPDATE_QUEUE_SIZE
+
+
+class UserDispatcher():
+    """
+    Runs jobs in a worker pool.
+
+    Jobs with the same key (chat id) are run one by one in submission order,
+    jobs with different keys are run in parallel. At most max_pending jobs
+    wait or run at once, submit blocks until a job is done then, so a burst
+    of updates is held in the bounded update queue instead of memory.
+    """
+
+    def __init__(self,
+            workers: int = DISPATCH_WORKERS,
+            max_pending: int = UPDATE_QUEUE_SIZE) -> None:
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix='dispatch')
+        self.__queues: dict[int, deque[Callable[[], None]]] = dict()
+        self.__lock = threading.Lock()
+        # 0 means unbounded
+        self.__pending: Union[threading.Semaphore, None] =\
+                threading.Semaphore(max_pending) if max_pending > 0 else None
+
+    def submit(self, key: int, job: Callable[[], None]) -> None:
+        """Queues the job, blocks while max_pending jobs are waiting or running"""
+        if self.__pending is not None:
+            self.__pending.acquire()
+        with self.__lock:
+            queue = self.__queues.get(key)
+            if queue is not None:
+                # a worker is already draining this queue
+                queue.append(job)
+                return
+            self.__queues[key] = deque([job])
+        self.__executor.submit(self.__drain, key)
+
+    def shutdown(self) -> None:
+        self.__executor.shutdown(wait=True)
+
+    def __drain(self, key: int) -> None:
+        while True:
+            with self.__lock:
+                queue = self.__queues[key]
+                if len(queue) == 0:
+                    del self.__queues[key]
+                    return
+                job = queue.popleft()
+            try:
+                job()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if self.__pending is not None:
+                    self.__pending.release()
@@ -1,17 +1,15 @@
+import io
 import uuid
+import zipfile
 from pathlib import Path
-
-import pandas as pd
-import xlsxwriter as xls
-import xlsxwriter.worksheet as xls_worksheet
-import xlsxwriter.utility as xls_utility
+from typing import TYPE_CHECKING, BinaryIO, Iterator, Union
 
 from config import BOTTOM_BORDERED_FORMAT, CENTERED_HEADING_FORMAT,\
         COLUMN_BG_COLORED_FORMAT, DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE,\
-        HEADING_FORMAT, RIGHT_BORDERED_FORMAT, ROW_BG_COLORED_FORMAT,\
+        EXCEL_CONSTANT_MEMORY, EXCEL_READER, HEADING_FORMAT, RIGHT_BORDERED_FORMAT, ROW_BG_COLORED_FORMAT,\
         RUNTIME_FOLDER, WRAPPED_FORMAT, WRITTEN_TESTS_FOLDERNAME
 
-from ..models.excel import WrittenTestExcel, WrittenTestGroup,\
+from ..models.excel import ExcelReport, WrittenTestExcel, WrittenTestGroup,\
         WrittenTestQuestionData,\
         WrittenTestStudentData,\
         UpdatedTestExcel,\
@@ -22,41 +20,50 @@ from ..models.test import RawTest,\
         TestVariant,\
         TestAnswerType
 
+# pandas, openpyxl and xlsxwriter are heavy to import and only needed when a
+# file is read or written, they are imported on first use
+if TYPE_CHECKING:
+    import xlsxwriter as xls
+    import xlsxwriter.format as xls_format
+    import xlsxwriter.worksheet as xls_worksheet
+
 
 class ExcelService():
 
 
     # region Reading
 
-    def read_test(self, source: RawTest) -> Test:
+    def __init__(self,
+            reader: str = EXCEL_READER,
+            constant_memory: bool = EXCEL_CONSTANT_MEMORY) -> None:
+        self.__reader = reader
+        self.__constant_memory = constant_memory
+
+    def read_test(self,
+            source: RawTest,
+            file: Union[BinaryIO, None] = None) -> Test:
+        """Reads test from file if it is given, otherwise from source.filename"""
         filename = source.filename
         name = Path(filename).stem
         id = uuid.uuid4()
 
-        frame = pd.read_excel(filename, sheet_name=None)
-        variants = self.__read_variants(frame)
-
-        return Test(filename, id, name, variants)
-
-    def __read_variants(self, frame: dict[str, pd.DataFrame]) -> list[TestVariant]:
         variants: list[TestVariant] = []
-
-        for sheet_name in frame.keys():
-            id = uuid.uuid4()
-            name = sheet_name
-            sheet: pd.DataFrame = frame[sheet_name]
-            questions = self.__read_questions(sheet)
+        for sheet_name, rows in self.__read_sheets(filename, file):
+            questions = self.__read_questions(rows)
             sum_max_mark = sum(map(lambda q: q.max_mark, questions))
+            variants.append(TestVariant(uuid.uuid4(), sheet_name, questions, sum_max_mark))
 
-            variant = TestVariant(id, name, questions, sum_max_mark)
-            variants.append(variant)
-
-        return variants
+        return Test(filename, id, name, variants)
 
-    def __read_questions(self, sheet: pd.DataFrame) -> list[TestQuestion]:
+    def __read_questions(self, rows: Iterator[tuple]) -> list[TestQuestion]:
         questions: list[TestQuestion] = []
 
-        for row in sheet.to_dict(orient='records'):
+        header = next(rows, None)
+        if header is None: return questions
+
+        for values in rows:
+            if all(map(lambda v: v is None, values)): continue
+            row = dict(zip(header, values))
             id = uuid.uuid4()
 
             text = row['вопрос']
@@ -68,10 +75,10 @@ class ExcelService():
                 answer_variants = text[1:]
                 text = text[0]
 
-            answer = None if pd.isna(row['ответ']) else row['ответ']
+            answer = row['ответ']
             if answer is not None:
                 if type == TestAnswerType.MULTIPLE_CHOICE.value:
-                    answer = list(map(lambda a: int(a.strip()), answer.split(',')))
+                    answer = list(map(lambda a: int(a.strip()), str(answer).split(',')))
                 elif type == TestAnswerType.SINGLE_CHOICE.value:
                     answer = int(answer)
 
@@ -82,26 +89,78 @@ class ExcelService():
 
         return questions
 
-    def read_written_test(self, filename: str) -> UpdatedTestExcel:
+    def read_written_test(self,
+            filename: str,
+            file: Union[BinaryIO, None] = None) -> UpdatedTestExcel:
         name = Path(filename).stem
         test_name, test_date = name.split('_')
         student_datas: list[UpdatedStudentData] = []
 
-        frame = pd.read_excel(filename, sheet_name=None)
-        for sheet_name in list(frame.keys())[:-1]:
-            sheet_frame = frame[sheet_name]
-            student_rows = [sheet_frame.columns.tolist()] + sheet_frame.values.tolist()
-            if (len(student_rows) <= 3):
-                continue
-
-            for student_row in student_rows[3:]:
-                student_name = student_row[0]
-                marks = list(map(lambda mark: None if pd.isna(mark) else float(mark),\
-                        student_row[3:-1:2]))
-                student_data = UpdatedStudentData(student_name, marks)
-                student_datas.append(student_data)
+        # the last sheet is the summary of groups
+        for _, rows in self.__read_sheets(filename, file, data_only=True, skip_last=True):
+            student_datas += self.__read_students(rows)
         return UpdatedTestExcel(test_name, test_date, student_datas)
 
+    def __read_students(self, rows: Iterator[tuple]) -> list[UpdatedStudentData]:
+        student_datas: list[UpdatedStudentData] = []
+
+        header = next(rows, None)
+        if header is None: return student_datas
+        # marks follow answers up to the sum column, which ends the header
+        width = len(header)
+        while width > 0 and header[width - 1] is None:
+            width -= 1
+
+        for i, student_row in enumerate(rows):
+            if i < 2: continue # answers and column names
+            student_name = student_row[0] if len(student_row) > 0 else None
+            if student_name is None: continue
+            student_row = tuple(student_row[:width]) + (None,) * (width - len(student_row))
+            marks = list(map(lambda mark: None if mark is None or mark == '' else float(mark),\
+                    student_row[3:-1:2]))
+            student_datas.append(UpdatedStudentData(student_name, marks))
+        return student_datas
+
+    def __read_sheets(self,
+            filename: str,
+            file: Union[BinaryIO, None] = None,
+            data_only: bool = False,
+            skip_last: bool = False) -> Iterator[tuple[str, Iterator[tuple]]]:
+        """
+        Yields sheets of the workbook as name and rows of cell values,
+        without the last sheet if skip_last is set.
+
+        Rows of a sheet have to be consumed before the next sheet is taken.
+        Empty cells are None. The file is read if it is given, filename is
+        used for its extension then.
+        """
+        source = file if file is not None else filename
+        if self.__reader == 'openpyxl' and Path(filename).suffix in ['.xlsx', '.xlsm']:
+            import openpyxl
+            from openpyxl.utils.exceptions import InvalidFileException
+            try:
+                book = openpyxl.load_workbook(source, read_only=True, data_only=data_only)
+            except (InvalidFileException, zipfile.BadZipFile):
+                book = None
+            if book is None and file is not None:
+                file.seek(0)
+            if book is not None:
+                try:
+                    sheets = book.worksheets[:-1] if skip_last else book.worksheets
+                    for sheet in sheets:
+                        yield sheet.title, sheet.iter_rows(values_only=True)
+                finally:
+                    book.close()
+                return
+
+        # pandas reads formats openpyxl does not know, e.g. xls
+        import pandas as pd
+        frame = pd.read_excel(source, sheet_name=None, header=None)
+        sheet_items = list(frame.items())
+        for sheet_name, sheet in sheet_items[:-1] if skip_last else sheet_items:
+            sheet = sheet.astype(object).where(sheet.notna(), None)
+            yield str(sheet_name), iter(map(tuple, sheet.values.tolist()))
+
 
     # endregion
 
@@ -111,98 +170,90 @@ class ExcelService():
     def write_written_test(self,
             test: WrittenTestExcel) -> str:
         """Writes test results into excel and returns excel filename"""
-        filename = f'{RUNTIME_FOLDER}/{WRITTEN_TESTS_FOLDERNAME}/{test.name}_{test.date}.xlsx'
-        book = xls.Workbook(filename)
+        filename = f'{RUNTIME_FOLDER}/{WRITTEN_TESTS_FOLDERNAME}/{self.get_report_name(test)}'
+        self.__write_book(test, filename, { 'constant_memory': self.__constant_memory })
+        return filename
+
+    def write_report(self, test: WrittenTestExcel) -> ExcelReport:
+        """
+        Writes test results into excel in memory. In constant memory mode
+        rows are kept in temporary files until the workbook is assembled in
+        memory, in_memory would turn constant memory off.
+        """
+        content = io.BytesIO()
+        options = { 'constant_memory': True } if self.__constant_memory else { 'in_memory': True }
+        self.__write_book(test, content, options)
+        content.seek(0)
+        return ExcelReport(self.get_report_name(test), content)
+
+    def get_report_name(self, test: WrittenTestExcel) -> str:
+        return f'{test.name}_{test.date}.xlsx'
+
+    def __write_book(self,
+            test: WrittenTestExcel,
+            file: Union[str, BinaryIO],
+            options: dict) -> None:
+        import xlsxwriter as xls
+
+        # in constant memory mode rows are flushed to disk once a later row
+        # is written, so every sheet is written row by row
+        book = xls.Workbook(file, options)
         book.formats[0].set_font_size(DEFAULT_FONT_SIZE)
         book.formats[0].set_font_name(DEFAULT_FONT_NAME)
+        formats = ExcelFormats(book)
 
         student_mark_cells: dict[str, dict[str, str]] = dict()
         for variant in test.variants:
             sheet = book.add_worksheet(variant.name)
             sheet.freeze_panes(2, 2)
-            self.__write_questions(book, sheet, variant.questions)
-            mark_cells = self.__write_students(book, sheet, variant.students, len(variant.questions))
+            self.__write_questions(formats, sheet, variant.questions)
+            mark_cells = self.__write_students(formats, sheet, variant.students, len(variant.questions))
             for key in mark_cells.keys():
                 student_mark_cells[key] = { 'mark_cell': mark_cells[key], 'sheet': variant.name }
 
         sheet = book.add_worksheet('Группы')
-        self.__write_summary(book, sheet, test.summary.groups, student_mark_cells)
+        self.__write_summary(formats, sheet, test.summary.groups, student_mark_cells)
 
         book.close()
-        return filename
 
     def __write_questions(self,
-            book: xls.Workbook,
-            sheet: xls_worksheet.Worksheet,
+            formats: 'ExcelFormats',
+            sheet: 'xls_worksheet.Worksheet',
             questions: list[WrittenTestQuestionData]) -> None:
-        right_bordered_format = book.add_format(RIGHT_BORDERED_FORMAT)
-        column_bg_colored_format = book.add_format(COLUMN_BG_COLORED_FORMAT)
-        row_bg_colored_format = book.add_format(ROW_BG_COLORED_FORMAT)
-
-        sheet.set_row(0, None, row_bg_colored_format)
-        sheet.set_row(1, None, book.add_format({
-            **BOTTOM_BORDERED_FORMAT,
-            **ROW_BG_COLORED_FORMAT,
-            }))
-
-        sheet.set_column_pixels(0, 0, 250, column_bg_colored_format) # Column A
-        sheet.set_column_pixels(1, 1, 160, book.add_format({
-            **RIGHT_BORDERED_FORMAT,
-            **COLUMN_BG_COLORED_FORMAT,
-            })) # Column B
-
-        sheet.write('B1', 'Вопрос', book.add_format({
-            **HEADING_FORMAT,
-            **COLUMN_BG_COLORED_FORMAT,
-            **RIGHT_BORDERED_FORMAT,
-            }))
-        sheet.write('B2', 'Ответ', book.add_format({
-            **HEADING_FORMAT,
-            **COLUMN_BG_COLORED_FORMAT,
-            **RIGHT_BORDERED_FORMAT,
-            }))
-
-        col_offset = 1
+        import xlsxwriter.utility as xls_utility
+
+        sheet.set_row(0, None, formats.get(ROW_BG_COLORED_FORMAT))
+        sheet.set_row(1, None, formats.get(BOTTOM_BORDERED_FORMAT, ROW_BG_COLORED_FORMAT))
+
+        sheet.set_column_pixels(0, 0, 250, formats.get(COLUMN_BG_COLORED_FORMAT)) # Column A
+        sheet.set_column_pixels(1, 1, 160, formats.get(RIGHT_BORDERED_FORMAT, COLUMN_BG_COLORED_FORMAT)) # Column B
+        for i in range(len(questions)):
+            sheet.set_column_pixels(2 + 2 * i, 2 + 2 * i, 350)
+            sheet.set_column_pixels(3 + 2 * i, 3 + 2 * i, 45, formats.get(RIGHT_BORDERED_FORMAT))
+        sum_col = 2 + 2 * len(questions)
+        sheet.set_column_pixels(sum_col, sum_col, 55)
+
+        # Row 1: questions
+        sheet.write('B1', 'Вопрос', formats.get(HEADING_FORMAT, COLUMN_BG_COLORED_FORMAT, RIGHT_BORDERED_FORMAT))
+        for i, question in enumerate(questions):
+            sheet.write(0, 2 + 2 * i, question.question, formats.get(ROW_BG_COLORED_FORMAT, WRAPPED_FORMAT))
+            sheet.write(0, 3 + 2 * i, 'Балл',\
+                    formats.get(CENTERED_HEADING_FORMAT, ROW_BG_COLORED_FORMAT, RIGHT_BORDERED_FORMAT))
+        sheet.write(0, sum_col, 'Сумма', formats.get(CENTERED_HEADING_FORMAT, ROW_BG_COLORED_FORMAT))
+
+        # Row 2: answers and max marks
+        sheet.write('B2', 'Ответ', formats.get(HEADING_FORMAT, COLUMN_BG_COLORED_FORMAT, RIGHT_BORDERED_FORMAT))
         mark_cells = []
-        for question in questions:
-            sheet.set_column_pixels(1 + col_offset, 1 + col_offset, 350)
-            sheet.write(0, 1 + col_offset, question.question, book.add_format({
-                **ROW_BG_COLORED_FORMAT,
-                **WRAPPED_FORMAT,
-                }))
-            sheet.write(1, 1 + col_offset, question.answer, book.add_format({
-                **ROW_BG_COLORED_FORMAT,
-                **WRAPPED_FORMAT,
-                }))
-
-            sheet.set_column_pixels(1 + col_offset + 1, 1 + col_offset + 1, 45, right_bordered_format)
-            sheet.write(0, 1 + col_offset + 1, 'Балл', book.add_format({
-                **CENTERED_HEADING_FORMAT,
-                **ROW_BG_COLORED_FORMAT,
-                **RIGHT_BORDERED_FORMAT,
-                }))
-
-            mark_cell = xls_utility.xl_rowcol_to_cell(1, 1 + col_offset + 1)
+        for i, question in enumerate(questions):
+            sheet.write(1, 2 + 2 * i, question.answer, formats.get(ROW_BG_COLORED_FORMAT, WRAPPED_FORMAT))
+            mark_cell = xls_utility.xl_rowcol_to_cell(1, 3 + 2 * i)
             mark_cells.append(mark_cell)
-            sheet.write(mark_cell, question.max_mark, book.add_format({
-                **ROW_BG_COLORED_FORMAT,
-                **RIGHT_BORDERED_FORMAT,
-                }))
-
-            col_offset += 2
-
-        sheet.set_column_pixels(1 + col_offset, 1 + col_offset, 55)
-        sheet.write(0, 1 + col_offset, 'Сумма', book.add_format({
-            **CENTERED_HEADING_FORMAT,
-            **ROW_BG_COLORED_FORMAT,
-            }))
-        sheet.write(1, 1 + col_offset, f"=SUM({', '.join(mark_cells)})", book.add_format({
-            **ROW_BG_COLORED_FORMAT,
-            }))
+            sheet.write(mark_cell, question.max_mark, formats.get(ROW_BG_COLORED_FORMAT, RIGHT_BORDERED_FORMAT))
+        sheet.write(1, sum_col, f"=SUM({', '.join(mark_cells)})", formats.get(ROW_BG_COLORED_FORMAT))
 
     def __write_students(self,
-            book: xls.Workbook,
-            sheet: xls_worksheet.Worksheet,
+            formats: 'ExcelFormats',
+            sheet: 'xls_worksheet.Worksheet',
             students: list[WrittenTestStudentData],
             question_count: int) -> dict[str, str]:
         """
@@ -210,25 +261,19 @@ class ExcelService():
 
         Returns: student.id-sum_mark_cell map
         """
-        wrapped_format = book.add_format(WRAPPED_FORMAT)
-        sheet.write('A3', 'Студент', book.add_format({
-            **HEADING_FORMAT,
-            **COLUMN_BG_COLORED_FORMAT,
-            }))
-        sheet.write('B3', 'Группа', book.add_format({
-            **HEADING_FORMAT,
-            **COLUMN_BG_COLORED_FORMAT,
-            }))
+        import xlsxwriter.utility as xls_utility
+
+        wrapped_format = formats.get(WRAPPED_FORMAT)
+        heading_format = formats.get(HEADING_FORMAT, COLUMN_BG_COLORED_FORMAT)
+        column_format = formats.get(COLUMN_BG_COLORED_FORMAT)
+        sheet.write('A3', 'Студент', heading_format)
+        sheet.write('B3', 'Группа', heading_format)
 
         row_offset = 1
         sum_mark_cell_map = dict()
         for student in students:
-            sheet.write(2 + row_offset, 0, student.name, book.add_format({
-                **COLUMN_BG_COLORED_FORMAT,
-                }))
-            sheet.write(2 + row_offset, 1, student.group, book.add_format({
-                **COLUMN_BG_COLORED_FORMAT,
-                }))
+            sheet.write(2 + row_offset, 0, student.name, column_format)
+            sheet.write(2 + row_offset, 1, student.group, column_format)
 
             col_offset = 1
             mark_cells = []
@@ -253,16 +298,16 @@ class ExcelService():
         return sum_mark_cell_map
 
     def __write_summary(self,
-            book: xls.Workbook,
-            sheet: xls_worksheet.Worksheet,
+            formats: 'ExcelFormats',
+            sheet: 'xls_worksheet.Worksheet',
             groups: list[WrittenTestGroup],
             mark_cells: dict[str, dict[str, str]]) -> None:
         sheet.set_column_pixels(0, 0, 160) # Column A
         sheet.set_column_pixels(1, 1, 250) # Column B
         sheet.set_column_pixels(2, 2, 45) # Column C
 
-        heading_format = book.add_format(HEADING_FORMAT)
-        centered_heading_format = book.add_format(CENTERED_HEADING_FORMAT)
+        heading_format = formats.get(HEADING_FORMAT)
+        centered_heading_format = formats.get(CENTERED_HEADING_FORMAT)
 
         row_offset = 0
         for group in groups:
@@ -285,3 +330,28 @@ class ExcelService():
 
 
     # endregion
+
+
+class ExcelFormats():
+    """
+    Formats of a workbook by their properties.
+
+    Every distinct combination of properties is added to the workbook once,
+    instead of a new format for every written cell.
+    """
+
+    def __init__(self, book: 'xls.Workbook') -> None:
+        self.__book = book
+        self.__formats: dict[tuple, 'xls_format.Format'] = dict()
+
+    def get(self, *properties: dict) -> 'xls_format.Format':
+        """Returns format with merged properties, later ones override"""
+        merged: dict = dict()
+        for part in properties:
+            merged.update(part)
+        key = tuple(sorted(merged.items()))
+        format = self.__formats.get(key)
+        if format is None:
+            format = self.__book.add_format(merged)
+            self.__formats[key] = format
+        return format
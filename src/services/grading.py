@@ -0,0 +1,247 @@
+import queue
+import re
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Union, cast
+
+from config import GRADING_BATCH_SIZE, GRADING_QUEUE_SIZE, GRADING_THREADS,\
+        GRADING_WORKERS
+
+from ..models.test import AnswerKey, StudentWrittenTest, TestAnswer,\
+        TestAnswerType, TestAnswerValue, TestQuestion
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+@dataclass
+class GradingItem:
+    student_test: StudentWrittenTest
+    question: TestQuestion
+    answer: TestAnswer
+
+
+class BatchGrader():
+    """
+    Grades answers in batches.
+
+    Answers are grouped by question and every group is scored at once:
+    lecture answers with a single rapidfuzz cdist call against the
+    compiled reference text, choice answers with bit operations on
+    variant masks.
+    """
+
+    def __init__(self, workers: int = GRADING_WORKERS) -> None:
+        self.__workers = workers
+
+    def grade(self, items: list[GradingItem]) -> None:
+        """Sets marks of gradable answers in place"""
+        by_question: dict[str, list[GradingItem]] = dict()
+        for item in items:
+            by_question.setdefault(str(item.question.id), []).append(item)
+
+        for question_items in by_question.values():
+            question = question_items[0].question
+            answers = [item.answer for item in question_items]
+            marks = self.__grade_question(question, answers)
+            if marks is None: continue
+            for answer, mark in zip(answers, marks):
+                answer.mark = float(mark)
+
+    def __grade_question(self,
+            question: TestQuestion,
+            answers: list[TestAnswer]) -> Union['np.ndarray', None]:
+        # numpy and rapidfuzz are loaded by the first grading, not at startup
+        import numpy as np
+        from rapidfuzz import process
+        from rapidfuzz.distance import Indel
+
+        if question.answer is None: return None
+        if question.key is None:
+            question.key = compile_key(question)
+        key = question.key
+
+        if question.type == TestAnswerType.LECTURE.value:
+            texts = [cast(str, parse_answer(question, a.value)) for a in answers]
+            # normalized Indel similarity is Levenshtein.ratio, float64 keeps
+            # marks equal to ratio of a single answer
+            scores = process.cdist(texts, [key.text],\
+                    scorer=Indel.normalized_similarity,\
+                    dtype=np.float64,\
+                    workers=self.__workers)
+            return scores[:, 0]
+
+        masks = np.array([parse_answer(question, a.value) for a in answers], dtype=np.uint64)
+
+        if question.type == TestAnswerType.SINGLE_CHOICE.value:
+            return (masks == key.mask).astype(float)
+
+        if question.type == TestAnswerType.MULTIPLE_CHOICE.value:
+            # popcount of wrong choices over the bytes of every mask
+            wrong = (masks ^ np.uint64(key.mask)).astype('<u8')
+            wrong_counts = np.unpackbits(wrong.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            return (key.variant_count - wrong_counts) / key.variant_count
+
+        return None
+
+
+@dataclass
+class GradingStats:
+    depth: int # answers waiting in the queue
+    graded: int
+    last_lag: float # seconds from submission to saved mark
+    max_lag: float
+
+
+class GradingPipeline():
+    """
+    Grades answers in background threads.
+
+    Submitted answers go into a bounded queue. Worker threads take them in
+    micro-batches, grade every batch with BatchGrader and save marks of a
+    batch with one call of save_marks. Answers in work are counted per
+    written test, so that a finishing test waits only for its own answers.
+    """
+
+    def __init__(self,
+            grader: BatchGrader,
+            save_marks: Callable[[Any, list[GradingItem]], None],
+            threads: int = GRADING_THREADS,
+            queue_size: int = GRADING_QUEUE_SIZE,
+            batch_size: int = GRADING_BATCH_SIZE) -> None:
+        self.__grader = grader
+        self.__save_marks = save_marks
+        self.__batch_size = batch_size
+        self.__queue: queue.Queue = queue.Queue(queue_size)
+        self.__pending: dict[Any, int] = dict() # written test id -> answers in work
+        self.__pending_changed = threading.Condition()
+
+        self.__stats_lock = threading.Lock()
+        self.__graded = 0
+        self.__last_lag = 0.0
+        self.__max_lag = 0.0
+
+        for i in range(threads):
+            thread = threading.Thread(target=self.__work, name=f'grading-{i}', daemon=True)
+            thread.start()
+
+    def submit(self, written_test_id: Any, item: GradingItem) -> None:
+        """Queues answer for grading, blocks while the queue is full"""
+        with self.__pending_changed:
+            self.__pending[written_test_id] = self.__pending.get(written_test_id, 0) + 1
+        self.__queue.put((written_test_id, item, time.monotonic()))
+
+    def drain(self, written_test_id: Any = None) -> None:
+        """
+        Waits until submitted answers of the written test are graded and
+        saved, or answers of every test if no test is given
+        """
+        if written_test_id is None:
+            self.__queue.join()
+            return
+        with self.__pending_changed:
+            self.__pending_changed.wait_for(lambda: written_test_id not in self.__pending)
+
+    def stats(self) -> GradingStats:
+        with self.__stats_lock:
+            return GradingStats(self.__queue.qsize(), self.__graded,\
+                    self.__last_lag, self.__max_lag)
+
+    def __work(self) -> None:
+        while True:
+            batch = [self.__queue.get()]
+            while len(batch) < self.__batch_size:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.__grade_batch(batch)
+            except Exception:
+                # marks may be set in memory but not saved, they are reset to
+                # be graded and saved again when the test finishes
+                traceback.print_exc()
+                for _, item, _ in batch:
+                    item.answer.mark = None
+            finally:
+                self.__release(batch)
+                for _ in batch:
+                    self.__queue.task_done()
+
+    def __release(self, batch: list[tuple[Any, GradingItem, float]]) -> None:
+        with self.__pending_changed:
+            for written_test_id, _, _ in batch:
+                count = self.__pending[written_test_id] - 1
+                if count > 0:
+                    self.__pending[written_test_id] = count
+                else:
+                    del self.__pending[written_test_id]
+            self.__pending_changed.notify_all()
+
+    def __grade_batch(self, batch: list[tuple[Any, GradingItem, float]]) -> None:
+        self.__grader.grade([item for _, item, _ in batch])
+
+        by_test: dict[Any, list[GradingItem]] = dict()
+        for written_test_id, item, _ in batch:
+            if item.answer.mark is None: continue
+            by_test.setdefault(written_test_id, []).append(item)
+        for written_test_id, items in by_test.items():
+            self.__save_marks(written_test_id, items)
+
+        now = time.monotonic()
+        lag = max(now - submitted_at for _, _, submitted_at in batch)
+        with self.__stats_lock:
+            self.__graded += len(batch)
+            self.__last_lag = lag
+            self.__max_lag = max(self.__max_lag, lag)
+
+
+# region Answer keys
+
+def compile_key(question: TestQuestion) -> AnswerKey:
+    """Compiles question answer into the form used for grading"""
+    variant_count = len(question.answer_variants or [])
+    if question.type == TestAnswerType.MULTIPLE_CHOICE.value\
+            and question.answer_variants is None:
+        raise Exception('Cannot compile answer key. Answer variants' +\
+                ' are not provided for a MULTIPLE_CHOICE question.')
+
+    if question.answer is None:
+        return AnswerKey(None, 0, variant_count)
+    if question.type == TestAnswerType.LECTURE.value:
+        return AnswerKey(normalize_text(str(question.answer)), 0, variant_count)
+    return AnswerKey(None, choices_to_mask(question.answer, variant_count), variant_count)
+
+def parse_answer(question: TestQuestion, value: TestAnswerValue) -> Union[str, int]:
+    """
+    Parses student's answer into the form of the question key: normalized
+    text for LECTURE questions and variant mask for choice questions
+    """
+    if question.type == TestAnswerType.LECTURE.value:
+        return normalize_text(str(value))
+    variant_count = question.key.variant_count if question.key is not None\
+            else len(question.answer_variants or [])
+    return choices_to_mask(value, variant_count)
+
+def normalize_text(text: str) -> str:
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+def choices_to_mask(value: TestAnswerValue, variant_count: int) -> int:
+    """Converts 1-based variant numbers like '1, 3' or [1, 3] to a bitmask"""
+    if isinstance(value, int):
+        choices = [value]
+    elif isinstance(value, list):
+        choices = value
+    else:
+        choices = [int(number) for number in re.findall(r'\d+', str(value))]
+
+    mask = 0
+    for choice in choices:
+        if 1 <= choice <= variant_count:
+            mask |= 1 << (choice - 1)
+    return mask
+
+# endregion
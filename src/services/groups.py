@@ -1,10 +1,11 @@
 from pymongo import database
 
-from typing import Any, Union, cast
+from typing import Any, Union
 
 from config import GROUP_COLLECTION_NAME
 
 from ..models.group import RawGroup, Group
+from .cache import CacheStats, IdentityCache
 
 
 class GroupsTable():
@@ -12,25 +13,45 @@ class GroupsTable():
     def __init__(self,
             db: database.Database) -> None:
         self.__collection = db[GROUP_COLLECTION_NAME]
+        self.__cache = IdentityCache()
 
     def create(self, source: RawGroup) -> Group:
         doc = { 'name': source.name }
         insert_result = self.__collection.insert_one(doc)
-        found = self.__collection.find_one({ '_id': insert_result.inserted_id })
-        return self.__from_document(cast(dict, found))
+        self.__cache.clear()
+        return Group(source.name, insert_result.inserted_id)
+
+    def create_many(self, sources: list[RawGroup]) -> list[Group]:
+        if len(sources) == 0: return []
+        docs = [{ 'name': source.name } for source in sources]
+        insert_result = self.__collection.insert_many(docs)
+        self.__cache.clear()
+        return [Group(source.name, id) for source, id in zip(sources, insert_result.inserted_ids)]
 
     def get_all(self) -> list[Group]:
+        return list(self.__cache.get(('all',), self.__find_all))
+
+    def get(self, property: str, value: Any) -> Union[Group, None]:
+        if property in ['_id', 'name']:
+            return self.__cache.get((property, value), lambda: self.__find(property, value))
+        return self.__find(property, value)
+
+    def remove_all(self) -> None:
+        self.__collection.delete_many({})
+        self.__cache.clear()
+
+    def cache_stats(self) -> CacheStats:
+        return self.__cache.stats()
+
+    def __find_all(self) -> list[Group]:
         found = self.__collection.find()
         return list(map(lambda doc: self.__from_document(doc), found))
 
-    def get(self, property: str, value: Any) -> Union[Group, None]:
+    def __find(self, property: str, value: Any) -> Union[Group, None]:
         found = self.__collection.find_one({ property: value })
         if found is None: return
         return self.__from_document(found)
 
-    def remove_all(self) -> None:
-        self.__collection.delete_many({})
-
     def __from_document(self, doc: dict) -> Group:
         return Group(doc['name'], doc['_id'])
     
@@ -0,0 +1,131 @@
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Callable, Union
+
+from config import REPORT_WORKERS
+
+from ..models.excel import ExcelReport, WrittenTestExcel
+from .excels import ExcelService
+
+
+@dataclass
+class ReportJob:
+    written_test_id: Any
+    future: Union[Future, None] = None # None while the test is being finished
+    cancelled: bool = False
+
+
+class ReportPool():
+    """
+    Writes reports of finished tests in worker processes.
+
+    Building a big workbook holds the GIL for seconds, in a worker process
+    it does not slow down handlers of other updates. One job runs per
+    written test, a test finished again while its report is being written
+    is skipped. With no workers reports are written by a background thread.
+    """
+
+    def __init__(self, workers: int = REPORT_WORKERS) -> None:
+        self.__workers = workers
+        self.__executor = self.__create_executor()
+        self.__jobs: dict[Any, ReportJob] = dict()
+        self.__lock = threading.Lock()
+
+    def submit(self,
+            written_test_id: Any,
+            build: Callable[[], WrittenTestExcel],
+            on_report: Callable[[Union[ExcelReport, None]], None]) -> bool:
+        """
+        Builds the report data in the calling thread and writes the report
+        in a worker. on_report gets the report or None if writing has failed,
+        it is not called for cancelled jobs.
+
+        Returns False if the report of the written test is already in work.
+        """
+        with self.__lock:
+            if written_test_id in self.__jobs: return False
+            job = ReportJob(written_test_id)
+            self.__jobs[written_test_id] = job
+
+        try:
+            excel = build()
+        except Exception:
+            self.__remove(job)
+            raise
+
+        with self.__lock:
+            if job.cancelled: return True
+            executor = self.__executor
+            job.future = executor.submit(write_report, excel)
+        job.future.add_done_callback(lambda future: self.__done(job, executor, future, on_report))
+        return True
+
+    def cancel(self, written_test_id: Any) -> bool:
+        """
+        Cancels the job of the written test. A report which is already
+        being written is dropped when it is done.
+        """
+        with self.__lock:
+            job = self.__jobs.pop(written_test_id, None)
+            if job is None: return False
+            job.cancelled = True
+            if job.future is not None:
+                job.future.cancel()
+            return True
+
+    def cancel_all(self) -> None:
+        for written_test_id in self.get_all():
+            self.cancel(written_test_id)
+
+    def get_all(self) -> list[Any]:
+        """Returns ids of written tests whose reports are in work"""
+        with self.__lock:
+            return list(self.__jobs.keys())
+
+    def shutdown(self) -> None:
+        """Waits until submitted reports are written and delivered"""
+        self.__executor.shutdown(wait=True)
+
+    def __done(self,
+            job: ReportJob,
+            executor: Executor,
+            future: Future,
+            on_report: Callable[[Union[ExcelReport, None]], None]) -> None:
+        self.__remove(job)
+        if job.cancelled or future.cancelled(): return
+
+        error = future.exception()
+        if error is None:
+            on_report(future.result())
+            return
+
+        traceback.print_exception(type(error), error, error.__traceback__)
+        if isinstance(error, BrokenProcessPool):
+            # a killed worker breaks the pool for every later job. The
+            # callback runs in a thread of the broken pool, which cannot
+            # be waited for here
+            with self.__lock:
+                if self.__executor is executor:
+                    self.__executor = self.__create_executor()
+                    executor.shutdown(wait=False)
+        on_report(None)
+
+    def __remove(self, job: ReportJob) -> None:
+        with self.__lock:
+            if self.__jobs.get(job.written_test_id) is job:
+                self.__jobs.pop(job.written_test_id)
+
+    def __create_executor(self) -> Executor:
+        if self.__workers == 0:
+            return ThreadPoolExecutor(1, thread_name_prefix='reports')
+        return ProcessPoolExecutor(self.__workers,\
+                mp_context=multiprocessing.get_context('spawn'))
+
+
+def write_report(excel: WrittenTestExcel) -> ExcelReport:
+    """Runs in a worker process"""
+    return ExcelService().write_report(excel)
@@ -0,0 +1,42 @@
+import threading
+from typing import Any, Union
+
+from ..models.session import TestSession
+from ..models.test import StudentWrittenTest, Test, WrittenTest
+
+
+class TestSessionCache():
+    """In-process storage of written tests which are in progress"""
+
+    def __init__(self) -> None:
+        self.__sessions: dict[Any, TestSession] = dict()
+        self.__lock = threading.Lock()
+
+    def put(self, written_test: WrittenTest, test: Test) -> TestSession:
+        """
+        Caches the written test unless it is cached already and returns the
+        cached session, concurrent puts of a test share a single session
+        """
+        students = dict([(student_test.student_id, student_test)\
+                for student_test in written_test.student_tests])
+        with self.__lock:
+            return self.__sessions.setdefault(written_test.id,\
+                    TestSession(written_test, test, students))
+
+    def get(self, written_test_id: Any) -> Union[TestSession, None]:
+        return self.__sessions.get(written_test_id)
+
+    def get_student(self,
+            written_test_id: Any,
+            student_id: int) -> Union[StudentWrittenTest, None]:
+        session = self.get(written_test_id)
+        if session is None: return None
+        return session.students.get(student_id)
+
+    def drop(self, written_test_id: Any) -> None:
+        with self.__lock:
+            self.__sessions.pop(written_test_id, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__sessions.clear()
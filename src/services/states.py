@@ -0,0 +1,62 @@
+import threading
+from typing import Union
+
+from pymongo import database
+
+from config import DIALOG_STATE_COLLECTION_NAME
+
+from ..models.dialog import DialogRecord
+
+
+class DialogStatesTable():
+    """
+    Stores the dialog state of every user.
+
+    Records are cached in memory and written through to the database, so
+    a restarted bot continues dialogs from where they stopped.
+    """
+
+    def __init__(self,
+            db: database.Database) -> None:
+        self.__collection = db[DIALOG_STATE_COLLECTION_NAME]
+        self.__cache: dict[int, DialogRecord] = dict()
+        self.__lock = threading.Lock()
+
+    def get(self, user_id: int) -> Union[DialogRecord, None]:
+        with self.__lock:
+            record = self.__cache.get(user_id)
+        if record is not None: return record
+
+        found = self.__collection.find_one({ 'user_id': user_id })
+        if found is None: return None
+        record = self.__from_document(found)
+        with self.__lock:
+            self.__cache[user_id] = record
+        return record
+
+    def save(self, record: DialogRecord) -> None:
+        with self.__lock:
+            self.__cache[record.user_id] = record
+        self.__collection.replace_one({ 'user_id': record.user_id },\
+                self.__to_document(record), upsert=True)
+
+    def remove_all(self) -> None:
+        with self.__lock:
+            self.__cache.clear()
+        self.__collection.delete_many({})
+
+    def __to_document(self, record: DialogRecord) -> dict:
+        return { 'user_id': record.user_id,\
+                'state': record.state,\
+                'question_index': record.question_index,\
+                'test_id': record.test_id,\
+                'written_test_id': record.written_test_id,\
+                'group_id': record.group_id }
+
+    def __from_document(self, doc: dict) -> DialogRecord:
+        return DialogRecord(doc['user_id'],\
+                doc['state'],\
+                doc['question_index'],\
+                doc['test_id'],\
+                doc['written_test_id'],\
+                doc['group_id'])
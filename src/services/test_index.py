@@ -0,0 +1,89 @@
+import threading
+import uuid
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, Union
+
+from ..models.test import Test, TestQuestion, TestVariant
+
+
+@dataclass(frozen=True)
+class VariantIndex:
+    variant: TestVariant
+    questions: tuple[TestQuestion, ...]
+    questions_by_id: Mapping[uuid.UUID, TestQuestion]
+
+
+class TestIndex():
+    """
+    Lookups of a loaded test.
+
+    Variants are indexed once on the first access, so variants of a
+    LazyTest are not decoded while only its name is read.
+    """
+
+    def __init__(self, test: Test) -> None:
+        self.test = test
+        self.__variants: Union[Mapping[uuid.UUID, VariantIndex], None] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def variants(self) -> Mapping[uuid.UUID, VariantIndex]:
+        if self.__variants is None:
+            with self.__lock:
+                if self.__variants is None:
+                    self.__variants = index_variants(self.test)
+        return self.__variants
+
+
+def index_variants(test: Test) -> Mapping[uuid.UUID, VariantIndex]:
+    variants: dict[uuid.UUID, VariantIndex] = dict()
+    for variant in test.variants:
+        questions = tuple(variant.questions)
+        questions_by_id = MappingProxyType(dict([(q.id, q) for q in questions]))
+        variants[variant.id] = VariantIndex(variant, questions, questions_by_id)
+    return MappingProxyType(variants)
+
+
+class TestIndexCache():
+    """Indexes of loaded tests by test id, kept for the process lifetime"""
+
+    def __init__(self) -> None:
+        self.__indexes: dict[Any, TestIndex] = dict()
+        self.__by_content: dict[tuple[str, str], TestIndex] = dict() # name, hash -> index
+        self.__lock = threading.Lock()
+
+    def get(self,
+            test_id: Any,
+            load: Callable[[], Union[Test, None]]) -> Union[TestIndex, None]:
+        """Returns index of the test, loads the test if it is not indexed yet"""
+        with self.__lock:
+            index = self.__indexes.get(test_id)
+        if index is not None: return index
+
+        test = load()
+        if test is None: return None
+        return self.put(test)
+
+    def find(self, test_id: Any) -> Union[TestIndex, None]:
+        """Returns index of the test if it is already indexed"""
+        with self.__lock:
+            return self.__indexes.get(test_id)
+
+    def find_by_content(self, name: str, content_hash: str) -> Union[TestIndex, None]:
+        """Returns index of the test uploaded with the name from a file with the hash"""
+        with self.__lock:
+            return self.__by_content.get((name, content_hash))
+
+    def put(self, test: Test) -> TestIndex:
+        index = TestIndex(test)
+        with self.__lock:
+            self.__indexes[test.id] = index
+            if test.content_hash is not None:
+                self.__by_content[(test.name, test.content_hash)] = index
+        return index
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__indexes.clear()
+            self.__by_content.clear()
@@ -1,58 +1,149 @@
+import hashlib
 import uuid
-import random
-from typing import Any, Union, cast
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Union
 
 from pymongo import database
-import Levenshtein
 
-from config import TEST_COLLECTION_NAME, WRITTEN_TEST_COLLECTION_NAME
+from config import TEST_COLLECTION_NAME, VARIANT_SEED, VARIANT_STRATEGY,\
+        WRITTEN_TEST_STORAGE, WRITTEN_TESTS_FOLDERNAME
 
+from .archive import FileArchive
 from .excels import ExcelService
+from .reports import ReportPool
+from .grading import BatchGrader, GradingItem, GradingPipeline, GradingStats,\
+        compile_key
+from .sessions import TestSessionCache
+from .test_index import TestIndex, TestIndexCache
+from .variants import VariantStrategy, create_variant_strategy
+from .written_storage import WrittenTestStorage, create_written_storage
 from ..utils.get_current_time import get_current_time
 from .users import UsersTable
 from .groups import GroupsTable
-from ..models.excel import WrittenTestExcel, WrittenTestGroup, WrittenTestStudentAnswer, WrittenTestStudentData, WrittenTestVariantSheet,\
+from ..models.excel import ExcelReport, WrittenTestExcel, WrittenTestGroup, WrittenTestStudentAnswer, WrittenTestStudentData, WrittenTestVariantSheet,\
         WrittenTestSummarySheet, WrittenTestQuestionData
-from ..models.test import RawTest, Test, TestAnswerValue, TestQuestion,\
-        TestVariant, StudentWrittenTest,\
-        WrittenTest, TestAnswer, TestAnswerType
+from ..models.test import AnswerKey, LazyTest, RawTest, Test, TestQuestion,\
+        TestSummary, TestVariant, StudentWrittenTest,\
+        WrittenTest, TestAnswer
 from ..utils.get_from_list import get_from_list
 
 
 class TestsTable():
 
     def __init__(self,
-            db: database.Database) -> None:
+            db: database.Database,
+            users: UsersTable,
+            groups: GroupsTable,
+            variant_strategy: Union[VariantStrategy, None] = None,
+            written_storage: Union[WrittenTestStorage, None] = None,
+            archive: Union[FileArchive, None] = None,
+            reports: Union[ReportPool, None] = None) -> None:
         self.__collection = db[TEST_COLLECTION_NAME]
-        self.__written_collection = db[WRITTEN_TEST_COLLECTION_NAME]
+        self.__written = written_storage\
+                or create_written_storage(WRITTEN_TEST_STORAGE, db)
 
-        self.__students = UsersTable(db)
-        self.__groups = GroupsTable(db)
+        self.__students = users
+        self.__groups = groups
         self.__excel = ExcelService()
+        self.__archive = archive or FileArchive(False)
+        self.__reports = reports or ReportPool()
+        self.__sessions = TestSessionCache()
+        self.__indexes = TestIndexCache()
+        self.__variant_strategy = variant_strategy\
+                or create_variant_strategy(VARIANT_STRATEGY, VARIANT_SEED)
+        self.__grader = BatchGrader()
+        self.__grading = GradingPipeline(self.__grader, self.__save_marks)
 
 
     # region Test entities
 
-    def create(self, source: RawTest) -> Test:
-        test = self.__excel.read_test(source)
+    def create(self,
+            source: RawTest,
+            file: Union[BinaryIO, None] = None) -> Test:
+        """
+        Parses and saves the uploaded test. A file which has already been
+        uploaded under the same name is found by its name and content hash,
+        its saved test is returned.
+        """
+        # the file name is the name of the test
+        name = Path(source.filename).stem
+        content_hash = self.__hash_content(source, file)
+        found = self.__find_by_content(name, content_hash)
+        if found is not None: return found
+
+        test = self.__excel.read_test(source, file)
+        test.content_hash = content_hash
+        for variant in test.variants:
+            for question in variant.questions:
+                question.key = compile_key(question)
 
         doc = self.__test_to_document(test)
         insert_result = self.__collection.insert_one(doc)
-        found = self.__collection.find_one({ '_id': insert_result.inserted_id })
-
-        return self.__test_from_document(cast(dict, found))
+        test.id = insert_result.inserted_id
+        self.__indexes.put(test)
+        return test
+
+    def __hash_content(self,
+            source: RawTest,
+            file: Union[BinaryIO, None] = None) -> str:
+        content = hashlib.sha256()
+        f = file if file is not None else open(source.filename, 'rb')
+        try:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                content.update(chunk)
+        finally:
+            if file is None: f.close()
+            else: file.seek(0)
+        return content.hexdigest()
+
+    def __find_by_content(self, name: str, content_hash: str) -> Union[Test, None]:
+        index = self.__indexes.find_by_content(name, content_hash)
+        if index is not None: return index.test
+        found = self.__collection.find_one({ 'content_hash': content_hash, 'name': name }, { '_id': 1 })
+        if found is None: return
+        return self.get('_id', found['_id'])
 
     def get(self, property: str, value: Any) -> Union[Test, None]:
+        if property == '_id':
+            index = self.get_index(value)
+            return index.test if index is not None else None
         found = self.__collection.find_one({ property: value })
         if found is None: return
         return self.__test_from_document(found)
 
+    def get_index(self, test_id: Any) -> Union[TestIndex, None]:
+        return self.__indexes.get(test_id, lambda: self.__find_test(test_id))
+
+    def __find_test(self, test_id: Any) -> Union[Test, None]:
+        found = self.__collection.find_one({ '_id': test_id })
+        if found is None: return
+        return self.__test_from_document(found)
+
     def get_all(self) -> list[Test]:
         found = self.__collection.find()
         return list(map(lambda doc: self.__test_from_document(doc), found))
 
+    def list_names(self) -> list[str]:
+        found = self.__collection.find({}, { 'name': 1 })
+        return [doc['name'] for doc in found]
+
+    def get_name(self, test_id: Any) -> Union[str, None]:
+        index = self.__indexes.find(test_id)
+        if index is not None: return index.test.name
+        found = self.__collection.find_one({ '_id': test_id }, { 'name': 1 })
+        if found is None: return
+        return found['name']
+
+    def get_summary(self, property: str, value: Any) -> Union[TestSummary, None]:
+        found = self.__collection.find_one({ property: value },\
+                { 'name': 1, 'filename': 1, 'variants.id': 1 })
+        if found is None: return
+        return TestSummary(found['_id'], found['name'], found['filename'],\
+                len(found['variants']))
+
     def remove_all(self) -> None:
         self.__collection.delete_many({})
+        self.__indexes.clear()
 
     def __convert_to_excel(self, written_test: WrittenTest) -> WrittenTestExcel:
         test = self.get('_id', written_test.test_id)
@@ -69,6 +160,8 @@ class TestsTable():
             for question in variant.questions:
                 question_text = question.text
                 answer = question.answer or ''
+                if isinstance(answer, list):
+                    answer = ', '.join(map(str, answer))
                 max_mark = question.max_mark
 
                 question_data_element = WrittenTestQuestionData(question_text, answer, max_mark)
@@ -135,15 +228,25 @@ class TestsTable():
                         'text': question.text,\
                         'answer_variants': question.answer_variants,\
                         'answer': question.answer,\
-                        'max_mark': question.max_mark }
+                        'max_mark': question.max_mark,\
+                        'key': self.__key_to_document(question.key) }
                 question_docs.append(question_doc)
 
             doc['questions'] = question_docs
             variant_docs.append(doc)
 
-        return { 'filename': test.filename, 'name': test.name, 'variants': variant_docs}
+        return { 'filename': test.filename,\
+                'name': test.name,\
+                'content_hash': test.content_hash,\
+                'variants': variant_docs }
 
     def __test_from_document(self, doc: dict) -> Test:
+        # tests uploaded before content hashes were introduced have no hash
+        return LazyTest(doc['filename'], doc['_id'], doc['name'],\
+                lambda: self.__variants_from_document(doc),\
+                doc.get('content_hash'))
+
+    def __variants_from_document(self, doc: dict) -> list[TestVariant]:
         variants = []
         for variant_doc in doc['variants']:
             questions = []
@@ -156,12 +259,24 @@ class TestsTable():
                         question_doc['answer'],\
                         question_doc['max_mark'],\
                         uuid.UUID(question_doc['id']))
+                # tests uploaded before answer keys were introduced have no key
+                key_doc = question_doc.get('key')
+                question.key = self.__key_from_document(key_doc) if key_doc\
+                        else compile_key(question)
                 questions.append(question)
 
             variant = TestVariant(uuid.UUID(variant_doc['id']), variant_doc['name'], questions, variant_doc['sum_max_mark'])
             variants.append(variant)
 
-        return Test(doc['filename'], doc['_id'], doc['name'], variants)
+        return variants
+
+    def __key_to_document(self, key: Union[AnswerKey, None]) -> Union[dict, None]:
+        if key is None: return None
+        # masks are stored as strings, BSON integers are limited to 64 bits
+        return { 'text': key.text, 'mask': str(key.mask), 'variant_count': key.variant_count }
+
+    def __key_from_document(self, doc: dict) -> AnswerKey:
+        return AnswerKey(doc['text'], int(doc['mask']), doc['variant_count'])
 
     # endregion
 
@@ -170,40 +285,76 @@ class TestsTable():
 
     def start(self,
             test_id: uuid.UUID,
-            student_ids: list[int]) -> WrittenTest:
+            student_ids: list[int],
+            variant_strategy: Union[VariantStrategy, None] = None) -> WrittenTest:
         test = self.get('_id', test_id)
         if test is None:
             raise Exception('Test was not found')
+        if len(test.variants) == 0:
+            raise Exception('Test has no variants')
 
         id = uuid.uuid4()
         start_time = get_current_time()
         finish_time = None
         student_tests: list[StudentWrittenTest] = []
 
-        for student_id in student_ids:
+        strategy = variant_strategy or self.__variant_strategy
+        variants = strategy.assign(test.variants, student_ids)
+        for student_id, variant in zip(student_ids, variants):
             id = uuid.uuid4()
             finish_time = None
-            variant = self.get_random_variant(test_id)
-            if variant is None:
-                raise Exception('Random variant was not found')
             answers = []
             student_test = StudentWrittenTest(id, finish_time, student_id, variant.id, answers, None)
             student_tests.append(student_test)
 
-        doc = self.__written_to_document(WrittenTest(id, test_id, start_time, finish_time, student_tests))
-        insert_result = self.__written_collection.insert_one(doc)
-        found = self.__written_collection.find_one({ '_id': insert_result.inserted_id })
-        return self.__written_from_document(cast(dict, found))
+        written_test = WrittenTest(id, test_id, start_time, finish_time, student_tests)
+        written_test.id = self.__written.insert(written_test)
+
+        self.__sessions.put(written_test, test)
+        return written_test
 
     def get_written(self, property: str, value: Any) -> Union[WrittenTest, None]:
-        found = self.__written_collection.find_one({ property: value })
-        if found is None: return
-        return self.__written_from_document(found)
+        if property == '_id':
+            session = self.__sessions.get(value)
+            if session is not None: return session.written_test
+        written_test = self.__written.find(property, value)
+        if written_test is None: return
+
+        # test is still running, e.g. the bot was restarted during it
+        if property == '_id' and written_test.finish_time is None:
+            test = self.get('_id', written_test.test_id)
+            if test is not None:
+                return self.__sessions.put(written_test, test).written_test
+        return written_test
 
     def remove_written(self) -> None:
-        self.__written_collection.delete_many({})
+        self.__reports.cancel_all()
+        self.__written.remove_all()
+        self.__sessions.clear()
+
+    def finish(self, written_test_id: uuid.UUID) -> ExcelReport:
+        """Finishes the test and returns the report written in memory"""
+        report = self.__excel.write_report(self.__finish(written_test_id))
+        self.__archive_report(report)
+        return report
+
+    def finish_in_background(self,
+            written_test_id: uuid.UUID,
+            on_report: Callable[[Union[ExcelReport, None]], None]) -> bool:
+        """
+        Finishes the test and writes the report in a worker process.
+        on_report gets the report or None if writing has failed.
 
-    def finish(self, written_test_id: uuid.UUID) -> str:
+        Returns False if the test is already being finished.
+        """
+        def on_written(report: Union[ExcelReport, None]) -> None:
+            if report is not None:
+                self.__archive_report(report)
+            on_report(report)
+        return self.__reports.submit(written_test_id,\
+                lambda: self.__finish(written_test_id), on_written)
+
+    def __finish(self, written_test_id: uuid.UUID) -> WrittenTestExcel:
         test = self.get_written('_id', written_test_id)
         if test is None:
             raise Exception('Written test was not found')
@@ -214,11 +365,18 @@ class TestsTable():
             if student_test.finish_time is None:
                 student_test.finish_time = finish_time
 
-        self.__written_collection.update_one({ '_id': test.id }, {'$set': self.__written_to_document(test)})
+        self.__written.finish(test.id, finish_time)
 
+        # grade answers left after background grading, e.g. after a restart
+        self.__grading.drain(test.id)
+        self.__grade(test)
 
         excel = self.__convert_to_excel(test)
-        return self.__excel.write_written_test(excel)
+        self.__sessions.drop(test.id)
+        return excel
+
+    def __archive_report(self, report: ExcelReport) -> None:
+        self.__archive.save(WRITTEN_TESTS_FOLDERNAME, report.filename, report.content.getvalue())
 
     def finish_student(self,
             written_test_id: uuid.UUID,
@@ -228,24 +386,26 @@ class TestsTable():
 
         Sets finish time on his test.
         """
-        student_test = self.get_student(written_test_id, 'student_id', student_id)
+        test = self.get_written('_id', written_test_id)
+        if test is None:
+            raise Exception('Cannot finish test for a student. Test was not found')
+        student_test = self.get_student(None, 'student_id', student_id, test)
         if student_test is None:
             raise Exception('Written test was not found')
 
         finish_time = get_current_time()
         student_test.finish_time = finish_time
 
-        test = self.get_written('_id', written_test_id)
-        if test is None:
-            raise Exception('Cannot finish test for a student. Test was not found')
-        self.__written_collection.update_one({ '_id': test.id }, {'$set': self.__written_to_document(test)})
-
+        self.__written.finish_student(test.id, student_id, finish_time)
 
     def get_student(self,
             written_test_id: Union[uuid.UUID, None],
             student_test_prop: str,
             value: Any,
             written_test: Union[WrittenTest, None] = None) -> Union[StudentWrittenTest, None]:
+        if written_test_id is not None and student_test_prop == 'student_id':
+            session = self.__sessions.get(written_test_id)
+            if session is not None: return session.students.get(value)
         test = self.get_written('_id', written_test_id) if written_test_id else written_test
         if test is None: return None
         return get_from_list(test.student_tests, student_test_prop, value)
@@ -258,139 +418,98 @@ class TestsTable():
         written_test = self.get_written('_id', written_test_id)
         if written_test is None:
             raise Exception('Cannot save student\'s answer for a test. WrittenTest was not found')
-        student_test = self.get_student(None, 'student_id', student_id, written_test)
+        student_test = self.__sessions.get_student(written_test.id, student_id)\
+                or self.get_student(None, 'student_id', student_id, written_test)
         if student_test is None:
             raise Exception('Cannot save student\'s answer for a test. StudentTest was not found')
         question = self.get_question(written_test.test_id, student_test.variant_id, None, question_id)
         if question is None:
             raise Exception('Cannot save student\'s answer for a test. Question was not found')
 
-        mark = self.__check_answer(question, text)
+        # answer is stored ungraded and graded in background
         id = uuid.uuid4()
-        answer = TestAnswer(id, question_id, text, mark)
+        answer = TestAnswer(id, question_id, text, None)
 
         if student_test is None:
             raise Exception('Written test was not found')
         student_test.answers.append(answer)
 
-        self.__written_collection.update_one({ '_id': written_test.id }, {'$set': self.__written_to_document(written_test)})
+        self.__written.push_answer(written_test.id, student_id, answer)
+        self.__grading.submit(written_test.id, GradingItem(student_test, question, answer))
 
-    def __written_to_document(self, test: WrittenTest) -> dict:
-        student_docs = []
-        for student_test in test.student_tests:
-            doc = { 'id': str(student_test.id),\
-                    'finish_time': student_test.finish_time,\
-                    'student_id': student_test.student_id,\
-                    'variant_id': str(student_test.variant_id),\
-                    'sum_mark': student_test.sum_mark }
-            answer_docs = []
-            for answer in student_test.answers:
-                answer_doc = { 'id': str(answer.id),\
-                        'question_id': str(answer.question_id),\
-                        'value': answer.value,\
-                        'mark': answer.mark }
-                answer_docs.append(answer_doc)
-            doc['answers'] = answer_docs
-            student_docs.append(doc)
-        return { 'test_id': test.test_id,\
-                'start_time': test.start_time,\
-                'finish_time': test.finish_time,\
-                'student_tests': student_docs }
-
-    def __written_from_document(self, doc: dict) -> WrittenTest:
-        students = []
-        for student_doc in doc['student_tests']:
-            answers = []
+    def grading_stats(self) -> GradingStats:
+        return self.__grading.stats()
 
-            for answer_doc in student_doc['answers']:
-                answer = TestAnswer(uuid.UUID(answer_doc['id']),\
-                        uuid.UUID(answer_doc['question_id']),\
-                        answer_doc['value'],\
-                        answer_doc['mark'])
-                answers.append(answer)
-
-            student = StudentWrittenTest(uuid.UUID(student_doc['id']),\
-                    student_doc['finish_time'],\
-                    student_doc['student_id'],\
-                    uuid.UUID(student_doc['variant_id']),\
-                    answers,\
-                    student_doc['sum_mark'])
-            students.append(student)
-
-        return WrittenTest(doc['_id'],\
-                doc['test_id'],\
-                doc['start_time'],\
-                doc['finish_time'],\
-                students)
+    def shutdown(self) -> None:
+        self.__reports.shutdown()
+        self.__grading.drain()
 
     # endregion
 
 
     # region Check
 
-    def __check_answer(self,
-            question: TestQuestion,
-            answer: TestAnswerValue) -> Union[float, None]:
-        """Checks test question answer and returns mark if possible"""
-        if question.type == TestAnswerType.LECTURE.value:
-            return Levenshtein.ratio(\
-                    cast(str, question.answer),\
-                    cast(str, answer))
-
-        if question.type == TestAnswerType.SINGLE_CHOICE.value:
-            return int(question.answer == answer)
-
-        if question.type == TestAnswerType.MULTIPLE_CHOICE.value:
-            if question.answer_variants is None:
-                raise Exception('Cannot check answer. Answer variants' +\
-                        ' are not provided for a MULTIPLE_CHOICE question.')
-
-            correct_answers = []
-            student_answers = []
-            for i in range(len(question.answer_variants)):
-                correct_answers.append(i + 1 in cast(list[int], question.answer))
-                student_answers.append(i in cast(list[int], answer))
-            variant_count = len(question.answer_variants)
-            student_count = 0
-            for i in range(variant_count):
-                if correct_answers[i] == student_answers[i]:
-                    student_count += 1
-            return student_count / variant_count
-
-        return None
-
-    def post_finished(self, filename: str) -> WrittenTest:
+    def __grade(self, written_test: WrittenTest) -> None:
+        """Grades ungraded answers of the test and saves marks"""
+        items: list[GradingItem] = []
+        for student_test in written_test.student_tests:
+            for answer in student_test.answers:
+                if answer.mark is not None: continue
+                question = self.get_question(written_test.test_id, student_test.variant_id, None, answer.question_id)
+                if question is None:
+                    raise Exception('Cannot grade answers. Question was not found')
+                items.append(GradingItem(student_test, question, answer))
+
+        self.__grader.grade(items)
+        self.__save_marks(written_test.id, [item for item in items if item.answer.mark is not None])
+
+    def __save_marks(self, written_test_id: Any, items: list[GradingItem]) -> None:
+        self.__written.save_marks(written_test_id, items)
+
+    def post_finished(self,
+            filename: str,
+            file: Union[BinaryIO, None] = None) -> WrittenTest:
         """
         Saves updated test results.
         
         Returns written test id.
         """
-        updated_test = self.__excel.read_written_test(filename)
+        updated_test = self.__excel.read_written_test(filename, file)
         written_test = self.get_written('finish_time', updated_test.date)
         if written_test is None:
             raise Exception('Cannot save test results. Written test was not found')
 
+        test_index = self.get_index(written_test.test_id)
+        if test_index is None:
+            raise Exception('Cannot save test results. Test was not found')
+
+        names = [student.name for student in updated_test.students]
+        student_ids: dict[str, int] = dict()
+        for student_user in self.__students.get_students_by_names(names):
+            student_ids.setdefault(student_user.name, student_user.id)
+        student_tests = dict([(t.student_id, t) for t in written_test.student_tests])
+
+        updated: list[StudentWrittenTest] = []
         for student in updated_test.students:
-            student_user = self.__students.get_student('name', student.name)
-            if student_user is None:
+            student_id = student_ids.get(student.name)
+            if student_id is None:
                 raise Exception('Cannot save test results. Student was not found')
-            student_test = self.get_student(None, 'student_id', student_user.id, written_test)
+            student_test = student_tests.get(student_id)
             if student_test is None:
                 raise Exception('Cannot save test results. Student test was not found')
+            variant = test_index.variants.get(student_test.variant_id)
+            if variant is None or len(variant.questions) < len(student_test.answers):
+                raise Exception('Cannot save test results. Question was not found')
 
             student_test.sum_mark = 0
-            for i in range(len(student_test.answers)):
-                question = self.get_question(written_test.test_id, student_test.variant_id, i)
-                if question is None:
-                    raise Exception('Cannot save test results. Question was not found')
-
-                mark = student.marks[i]
+            for answer, question, mark in zip(student_test.answers, variant.questions, student.marks):
                 if mark is not None:
-                    student_test.answers[i].mark = mark / question.max_mark
-                student_test.sum_mark += (student_test.answers[i].mark or 0) * question.max_mark
+                    answer.mark = mark / question.max_mark
+                student_test.sum_mark += (answer.mark or 0) * question.max_mark
+
+            updated.append(student_test)
 
-        self.__written_collection.update_one({ '_id': written_test.id },\
-                {'$set': self.__written_to_document(written_test)})
+        self.__written.save_results(written_test.id, updated)
 
         return written_test
 
@@ -399,30 +518,30 @@ class TestsTable():
 
     # region Variants
 
-    def get_random_variant(self, test_id: uuid.UUID) -> Union[TestVariant, None]:
-        test = self.get('_id', test_id)
-        if test is None: return None
-        return random.choice(test.variants)
-
     def get_variant(self,
             test_id: uuid.UUID,
             variant_prop: str,
             value: Any) -> Union[TestVariant, None]:
-        test = self.get('_id', test_id)
-        if test is None: return None
+        index = self.get_index(test_id)
+        if index is None: return None
 
-        return get_from_list(test.variants, variant_prop, value)
+        if variant_prop == 'id':
+            variant_index = index.variants.get(value)
+            return variant_index.variant if variant_index is not None else None
+        return get_from_list(index.test.variants, variant_prop, value)
 
     def get_question(self,
             test_id: uuid.UUID,
             variant_id: uuid.UUID,
             index: Union[int, None] = None,
             question_id: Union[uuid.UUID, None] = None) -> Union[TestQuestion, None]:
-        variant = self.get_variant(test_id, 'id', variant_id)
+        test_index = self.get_index(test_id)
+        if test_index is None: return None
+        variant = test_index.variants.get(variant_id)
         if variant is None: return None
 
         if question_id is not None:
-            question = get_from_list(variant.questions, 'id', question_id)
+            question = variant.questions_by_id.get(question_id)
             if question is not None: return question
 
         if index is None: return None
@@ -1,11 +1,13 @@
-from typing import Any, Union, cast
-from pymongo import database
+from typing import Any, Union
+from pymongo import ReturnDocument, database
+from pymongo.errors import DuplicateKeyError
 
 import uuid
 
 from config import USER_COLLECTION_NAME
 
 from ..models.user import User, Student, RawStudent
+from .cache import CacheStats, IdentityCache
 
 
 class UsersTable():
@@ -13,25 +15,41 @@ class UsersTable():
     def __init__(self,
             db: database.Database) -> None:
         self.__collection = db[USER_COLLECTION_NAME]
+        self.__cache = IdentityCache()
 
 
     # region Tutor
 
     def has_tutor(self) -> bool:
-        found = self.__collection.find_one({ 'is_tutor': True })
+        found = self.__cache.get(('has_tutor',),\
+                lambda: self.__collection.find_one({ 'is_tutor': True }))
         return found is not None
 
     def create_tutor(self, id: int) -> User:
-        doc = { 'telegram_id': id, 'is_tutor': True }
-        insert_result = self.__collection.insert_one(doc)
-        found = self.__collection.find_one({ '_id': insert_result.inserted_id })
-        return self.__user_from_document(cast(dict, found))
+        """
+        Makes the user the tutor unless there is one, returns the tutor.
+
+        The tutor document is upserted by its role, which is unique, so
+        concurrent calls create a single tutor.
+        """
+        update = { '$setOnInsert': { 'telegram_id': id, 'is_tutor': True } }
+        try:
+            doc = self.__collection.find_one_and_update({ 'role': 'tutor' }, update,\
+                    upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # another call has inserted the tutor meanwhile
+            doc = self.__collection.find_one({ 'role': 'tutor' })
+            if doc is None:
+                raise Exception('Cannot create tutor. User is already registered as a student')
+        self.__cache.clear()
+        return self.__user_from_document(doc)
 
     def __user_from_document(self, doc: dict) -> User:
         return User(doc['telegram_id'], doc['is_tutor'])
 
     def remove_tutor(self) -> None:
         self.__collection.delete_one({ '$eq': { 'is_tutor': True } })
+        self.__cache.clear()
 
     # endregion
 
@@ -39,25 +57,43 @@ class UsersTable():
     # region Student
 
     def create_student(self, source: RawStudent) -> Student:
-        doc = { 'telegram_id': source.id, 'is_tutor': False, 'name': source.name, 'group_id': source.group_id }
-        insert_result = self.__collection.insert_one(doc)
-        found = self.__collection.find_one({ '_id': insert_result.inserted_id })
-        return self.__student_from_document(cast(dict, found))
+        self.__collection.insert_one(self.__student_to_document(source))
+        self.__cache.clear()
+        return Student(source.id, False, source.name, source.group_id)
+
+    def create_students(self, sources: list[RawStudent]) -> list[Student]:
+        if len(sources) == 0: return []
+        self.__collection.insert_many(list(map(lambda s: self.__student_to_document(s), sources)))
+        self.__cache.clear()
+        return [Student(source.id, False, source.name, source.group_id) for source in sources]
 
     def get_students(self, group_id: uuid.UUID) -> list[Student]:
         found = self.__collection.find({ 'is_tutor': False, 'group_id': group_id })
         return list(map(lambda doc: self.__student_from_document(doc), found))
 
+    def get_students_by_names(self, names: list[str]) -> list[Student]:
+        found = self.__collection.find({ 'is_tutor': False, 'name': { '$in': names } })
+        return list(map(lambda doc: self.__student_from_document(doc), found))
+
     def get_student(self, property: str, value: Any) -> Union[Student, None]:
+        if property == 'telegram_id':
+            return self.__cache.get(('student', value), lambda: self.__find_student(property, value))
+        return self.__find_student(property, value)
+
+    def __find_student(self, property: str, value: Any) -> Union[Student, None]:
         found = self.__collection.find_one({property: value})
         if found is None: return
         return self.__student_from_document(found)
 
+    def __student_to_document(self, source: RawStudent) -> dict:
+        return { 'telegram_id': source.id, 'is_tutor': False, 'name': source.name, 'group_id': source.group_id }
+
     def __student_from_document(self, doc: dict) -> Student:
         return Student(doc['telegram_id'], doc['is_tutor'], doc['name'], doc['group_id'])
 
     def remove_students(self) -> None:
         self.__collection.delete_many({ '$eq': { 'is_tutor': False } })
+        self.__cache.clear()
 
     # endregion
 
@@ -65,6 +101,9 @@ class UsersTable():
     # region User
 
     def get_user(self, id: int) -> Union[User, None]:
+        return self.__cache.get(('user', id), lambda: self.__find_user(id))
+
+    def __find_user(self, id: int) -> Union[User, None]:
         found = self.__collection.find_one({ 'telegram_id': id })
         if found is None: return
         return self.__user_from_document(found)
@@ -75,5 +114,9 @@ class UsersTable():
 
     def remove_users(self) -> None:
         self.__collection.delete_many({})
+        self.__cache.clear()
+
+    def cache_stats(self) -> CacheStats:
+        return self.__cache.stats()
 
     # endregion
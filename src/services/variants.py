@@ -0,0 +1,76 @@
+import random
+from typing import Protocol, Sequence, Union
+
+from ..models.test import TestVariant
+
+
+class VariantStrategy(Protocol):
+    """Assigns variants of a test to students"""
+
+    def assign(self,
+            variants: Sequence[TestVariant],
+            student_ids: list[int]) -> list[TestVariant]:
+        """Returns variant of every student in the order of student_ids"""
+        ...
+
+
+class RandomVariantStrategy():
+    """Picks a variant uniformly at random for every student"""
+
+    def __init__(self, rng: Union[random.Random, None] = None) -> None:
+        self.__rng = rng or random.Random()
+
+    def assign(self,
+            variants: Sequence[TestVariant],
+            student_ids: list[int]) -> list[TestVariant]:
+        return self.__rng.choices(variants, k=len(student_ids))
+
+
+class SeededVariantStrategy():
+    """
+    Picks a random variant which depends only on the seed and the student.
+
+    The same student gets the same variant on every start with the same
+    seed, whatever the other students are.
+    """
+
+    def __init__(self, seed: str) -> None:
+        self.__seed = seed
+
+    def assign(self,
+            variants: Sequence[TestVariant],
+            student_ids: list[int]) -> list[TestVariant]:
+        return [random.Random(f'{self.__seed}:{student_id}').choice(variants)\
+                for student_id in student_ids]
+
+
+class RoundRobinVariantStrategy():
+    """
+    Deals variants in turn, so that variant counts differ at most by one.
+
+    Students are shuffled first, neighbours in a list get different variants
+    but not predictably.
+    """
+
+    def __init__(self, rng: Union[random.Random, None] = None) -> None:
+        self.__rng = rng or random.Random()
+
+    def assign(self,
+            variants: Sequence[TestVariant],
+            student_ids: list[int]) -> list[TestVariant]:
+        order = list(range(len(student_ids)))
+        self.__rng.shuffle(order)
+        assigned: list[TestVariant] = [variants[0]] * len(student_ids)
+        for turn, i in enumerate(order):
+            assigned[i] = variants[turn % len(variants)]
+        return assigned
+
+
+def create_variant_strategy(name: str, seed: str = '') -> VariantStrategy:
+    if name == 'random':
+        return RandomVariantStrategy()
+    if name == 'seeded':
+        return SeededVariantStrategy(seed)
+    if name == 'round-robin':
+        return RoundRobinVariantStrategy()
+    raise Exception(f'Unknown variant strategy {name}')
@@ -0,0 +1,253 @@
+import uuid
+from typing import Any, Protocol, Union
+
+from pymongo import ReplaceOne, UpdateOne, database
+
+from config import STUDENT_TEST_COLLECTION_NAME, WRITTEN_TEST_COLLECTION_NAME
+
+from .grading import GradingItem
+from ..models.test import StudentWrittenTest, TestAnswer, WrittenTest
+
+
+class WrittenTestStorage(Protocol):
+    """Stores written tests with their student tests"""
+
+    def insert(self, written_test: WrittenTest) -> Any:
+        """Inserts written test and returns its id"""
+        ...
+
+    def find(self, property: str, value: Any) -> Union[WrittenTest, None]:
+        """Finds written test by a property of the written test document"""
+        ...
+
+    def finish(self, written_test_id: Any, finish_time: str) -> None:
+        """Sets finish time on the written test and its unfinished student tests"""
+        ...
+
+    def finish_student(self, written_test_id: Any, student_id: int, finish_time: str) -> None:
+        ...
+
+    def push_answer(self, written_test_id: Any, student_id: int, answer: TestAnswer) -> None:
+        ...
+
+    def save_marks(self, written_test_id: Any, items: list[GradingItem]) -> None:
+        """Saves marks of graded answers"""
+        ...
+
+    def save_results(self, written_test_id: Any, student_tests: list[StudentWrittenTest]) -> None:
+        """Saves answers and sum marks of student tests"""
+        ...
+
+    def remove_all(self) -> None:
+        ...
+
+
+class EmbeddedWrittenTestStorage():
+    """Keeps student tests embedded into the written test document"""
+
+    def __init__(self, db: database.Database) -> None:
+        self.__collection = db[WRITTEN_TEST_COLLECTION_NAME]
+
+    def insert(self, written_test: WrittenTest) -> Any:
+        doc = written_to_document(written_test)
+        doc['student_tests'] = list(map(lambda t: student_test_to_document(t), written_test.student_tests))
+        return self.__collection.insert_one(doc).inserted_id
+
+    def find(self, property: str, value: Any) -> Union[WrittenTest, None]:
+        found = self.__collection.find_one({ property: value })
+        if found is None: return
+        # written tests moved by migrate_to_student_tests have no student tests
+        return written_from_document(found, found.get('student_tests', []))
+
+    def finish(self, written_test_id: Any, finish_time: str) -> None:
+        self.__collection.update_one({ '_id': written_test_id },\
+                { '$set': {\
+                    'finish_time': finish_time,\
+                    'student_tests.$[unfinished].finish_time': finish_time,\
+                    } },\
+                array_filters=[{ 'unfinished.finish_time': None }])
+
+    def finish_student(self, written_test_id: Any, student_id: int, finish_time: str) -> None:
+        self.__collection.update_one({ '_id': written_test_id },\
+                { '$set': { 'student_tests.$[student].finish_time': finish_time } },\
+                array_filters=[{ 'student.student_id': student_id }])
+
+    def push_answer(self, written_test_id: Any, student_id: int, answer: TestAnswer) -> None:
+        self.__collection.update_one({ '_id': written_test_id },\
+                { '$push': { 'student_tests.$[student].answers': answer_to_document(answer) } },\
+                array_filters=[{ 'student.student_id': student_id }])
+
+    def save_marks(self, written_test_id: Any, items: list[GradingItem]) -> None:
+        updates = [UpdateOne({ '_id': written_test_id },\
+                { '$set': { 'student_tests.$[student].answers.$[answer].mark': item.answer.mark } },\
+                array_filters=[\
+                    { 'student.student_id': item.student_test.student_id },\
+                    { 'answer.id': str(item.answer.id) },\
+                    ]) for item in items]
+        if len(updates) > 0:
+            self.__collection.bulk_write(updates, ordered=False)
+
+    def save_results(self, written_test_id: Any, student_tests: list[StudentWrittenTest]) -> None:
+        updates = [UpdateOne({ '_id': written_test_id },\
+                { '$set': {\
+                    'student_tests.$[student].answers': list(map(lambda a: answer_to_document(a), student_test.answers)),\
+                    'student_tests.$[student].sum_mark': student_test.sum_mark,\
+                    } },\
+                array_filters=[{ 'student.student_id': student_test.student_id }])\
+                for student_test in student_tests]
+        if len(updates) > 0:
+            self.__collection.bulk_write(updates, ordered=False)
+
+    def remove_all(self) -> None:
+        self.__collection.delete_many({})
+
+
+class StudentTestsWrittenStorage():
+    """
+    Keeps every student test in its own document of the student tests
+    collection, so that students do not write into the same document.
+    """
+
+    def __init__(self, db: database.Database) -> None:
+        self.__collection = db[WRITTEN_TEST_COLLECTION_NAME]
+        self.__student_collection = db[STUDENT_TEST_COLLECTION_NAME]
+
+    def insert(self, written_test: WrittenTest) -> Any:
+        id = self.__collection.insert_one(written_to_document(written_test)).inserted_id
+        student_docs = list(map(lambda t: student_test_to_document(t, id), written_test.student_tests))
+        if len(student_docs) > 0:
+            self.__student_collection.insert_many(student_docs)
+        return id
+
+    def find(self, property: str, value: Any) -> Union[WrittenTest, None]:
+        found = self.__collection.find_one({ property: value })
+        if found is None: return
+        student_docs = self.__student_collection.find({ 'written_test_id': found['_id'] })
+        return written_from_document(found, student_docs)
+
+    def finish(self, written_test_id: Any, finish_time: str) -> None:
+        self.__collection.update_one({ '_id': written_test_id },\
+                { '$set': { 'finish_time': finish_time } })
+        self.__student_collection.update_many(\
+                { 'written_test_id': written_test_id, 'finish_time': None },\
+                { '$set': { 'finish_time': finish_time } })
+
+    def finish_student(self, written_test_id: Any, student_id: int, finish_time: str) -> None:
+        self.__student_collection.update_one(\
+                { 'written_test_id': written_test_id, 'student_id': student_id },\
+                { '$set': { 'finish_time': finish_time } })
+
+    def push_answer(self, written_test_id: Any, student_id: int, answer: TestAnswer) -> None:
+        self.__student_collection.update_one(\
+                { 'written_test_id': written_test_id, 'student_id': student_id },\
+                { '$push': { 'answers': answer_to_document(answer) } })
+
+    def save_marks(self, written_test_id: Any, items: list[GradingItem]) -> None:
+        updates = [UpdateOne(\
+                { 'written_test_id': written_test_id, 'student_id': item.student_test.student_id },\
+                { '$set': { 'answers.$[answer].mark': item.answer.mark } },\
+                array_filters=[{ 'answer.id': str(item.answer.id) }]) for item in items]
+        if len(updates) > 0:
+            self.__student_collection.bulk_write(updates, ordered=False)
+
+    def save_results(self, written_test_id: Any, student_tests: list[StudentWrittenTest]) -> None:
+        updates = [UpdateOne(\
+                { 'written_test_id': written_test_id, 'student_id': student_test.student_id },\
+                { '$set': {\
+                    'answers': list(map(lambda a: answer_to_document(a), student_test.answers)),\
+                    'sum_mark': student_test.sum_mark,\
+                    } }) for student_test in student_tests]
+        if len(updates) > 0:
+            self.__student_collection.bulk_write(updates, ordered=False)
+
+    def remove_all(self) -> None:
+        self.__collection.delete_many({})
+        self.__student_collection.delete_many({})
+
+
+def create_written_storage(name: str, db: database.Database) -> WrittenTestStorage:
+    if name == 'embedded':
+        return EmbeddedWrittenTestStorage(db)
+    if name == 'student-tests':
+        return StudentTestsWrittenStorage(db)
+    raise Exception(f'Unknown written test storage {name}')
+
+
+def migrate_to_student_tests(db: database.Database) -> int:
+    """
+    Moves embedded student tests into the student tests collection.
+
+    Can be run again after a failure, already moved student tests are
+    replaced. The migration is one-way: student tests are removed from
+    written test documents, the embedded storage sees migrated written
+    tests without students. Returns the number of migrated written tests.
+    """
+    collection = db[WRITTEN_TEST_COLLECTION_NAME]
+    student_collection = db[STUDENT_TEST_COLLECTION_NAME]
+
+    count = 0
+    for doc in collection.find({ 'student_tests': { '$exists': True } }):
+        replaces = []
+        for student_doc in doc['student_tests']:
+            key = { 'written_test_id': doc['_id'], 'student_id': student_doc['student_id'] }
+            replaces.append(ReplaceOne(key, { **student_doc, **key }, upsert=True))
+        if len(replaces) > 0:
+            student_collection.bulk_write(replaces, ordered=False)
+        collection.update_one({ '_id': doc['_id'] }, { '$unset': { 'student_tests': '' } })
+        count += 1
+    return count
+
+
+# region Documents
+
+def written_to_document(test: WrittenTest) -> dict:
+    return { 'test_id': test.test_id,\
+            'start_time': test.start_time,\
+            'finish_time': test.finish_time }
+
+def student_test_to_document(student_test: StudentWrittenTest,
+        written_test_id: Any = None) -> dict:
+    answer_docs = list(map(lambda a: answer_to_document(a), student_test.answers))
+    doc = { 'id': str(student_test.id),\
+            'finish_time': student_test.finish_time,\
+            'student_id': student_test.student_id,\
+            'variant_id': str(student_test.variant_id),\
+            'answers': answer_docs,\
+            'sum_mark': student_test.sum_mark }
+    if written_test_id is not None:
+        doc['written_test_id'] = written_test_id
+    return doc
+
+def answer_to_document(answer: TestAnswer) -> dict:
+    return { 'id': str(answer.id),\
+            'question_id': str(answer.question_id),\
+            'value': answer.value,\
+            'mark': answer.mark }
+
+def written_from_document(doc: dict, student_docs) -> WrittenTest:
+    students = []
+    for student_doc in student_docs:
+        answers = []
+
+        for answer_doc in student_doc['answers']:
+            answer = TestAnswer(uuid.UUID(answer_doc['id']),\
+                    uuid.UUID(answer_doc['question_id']),\
+                    answer_doc['value'],\
+                    answer_doc['mark'])
+            answers.append(answer)
+
+        student = StudentWrittenTest(uuid.UUID(student_doc['id']),\
+                student_doc['finish_time'],\
+                student_doc['student_id'],\
+                uuid.UUID(student_doc['variant_id']),\
+                answers,\
+                student_doc['sum_mark'])
+        students.append(student)
+
+    return WrittenTest(doc['_id'],\
+            doc['test_id'],\
+            doc['start_time'],\
+            doc['finish_time'],\
+            students)
+
+# endregion